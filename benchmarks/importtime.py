@@ -0,0 +1,102 @@
+"""Benchmark import times of `shinyutils` modules, and fail if they regress.
+
+Usage: python benchmarks/importtime.py [--repeats N] [--scale S]
+
+Each module is imported in a fresh interpreter with `python -X importtime`, and the
+import time of `shinyutils` modules is measured, excluding time spent importing
+dependencies that the module needs at load time (like `torch` for `shinyutils.pt`).
+The best time over `--repeats` runs is compared with the module's budget (multiplied
+by `--scale`, for slow machines). Independent of time, the benchmark also checks
+that modules don't import heavy dependencies which they should only load on first
+use. The exit code is 1 if any check fails.
+"""
+
+import argparse
+import subprocess
+import sys
+from typing import Dict, NamedTuple, Tuple
+
+
+class _Budget(NamedTuple):
+    ms: float
+    excluded: Tuple[str, ...] = ()
+    forbidden: Tuple[str, ...] = ()
+
+
+BUDGETS = {
+    "shinyutils": _Budget(20, forbidden=("corgy", "rich", "torch", "matplotlib")),
+    "shinyutils.logng": _Budget(50, forbidden=("corgy", "rich", "torch")),
+    "shinyutils.sh": _Budget(80, forbidden=("corgy", "rich", "torch")),
+    "shinyutils.matwrap": _Budget(
+        40, excluded=("corgy",), forbidden=("matplotlib", "seaborn")
+    ),
+    "shinyutils.pt": _Budget(
+        80, excluded=("torch", "corgy"), forbidden=("rich", "tensorboard")
+    ),
+}
+
+
+def _import_times(module: str) -> Dict[str, Tuple[int, int]]:
+    # Map imported module names to (cumulative time, nesting level), with times in
+    # microseconds, from the `-X importtime` output for importing `module`.
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        level = (len(name) - len(name.lstrip())) // 2
+        times[name.strip()] = (int(cumulative), level)
+    return times
+
+
+def _measure(module: str, budget: _Budget) -> Tuple[float, Tuple[str, ...]]:
+    # Return the import time of `module` (in milliseconds), and the forbidden modules
+    # that were imported.
+    times = _import_times(module)
+    total = sum(
+        _t
+        for _name, (_t, _level) in times.items()
+        if _level == 0 and (_name == "shinyutils" or _name.startswith("shinyutils."))
+    )
+    total -= sum(times[_name][0] for _name in budget.excluded if _name in times)
+    imported = tuple(_name for _name in budget.forbidden if _name in times)
+    return total / 1000, imported
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    arg_parser.add_argument(
+        "--repeats", type=int, default=5, help="number of runs per module"
+    )
+    arg_parser.add_argument(
+        "--scale", type=float, default=1.0, help="multiplier for time budgets"
+    )
+    args = arg_parser.parse_args()
+
+    failed = False
+    for module, budget in BUDGETS.items():
+        try:
+            runs = [_measure(module, budget) for _ in range(args.repeats)]
+        except subprocess.CalledProcessError as e:
+            print(f"{module}: skipped: import failed: {e.stderr.splitlines()[-1]}")
+            continue
+        best_ms = min(_ms for _ms, _ in runs)
+        limit_ms = budget.ms * args.scale
+        status = "ok"
+        if best_ms > limit_ms:
+            status, failed = "FAIL", True
+        print(f"{module}: {best_ms:.1f}ms (budget {limit_ms:.1f}ms): {status}")
+        if runs[0][1]:
+            failed = True
+            print(f"{module}: FAIL: imports {', '.join(runs[0][1])} at load time")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
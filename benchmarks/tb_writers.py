@@ -0,0 +1,56 @@
+"""Benchmark the overhead of `add_scalar` calls on `shinyutils.pt.TBLogs` writers.
+
+Usage: python benchmarks/tb_writers.py [--calls N]
+
+The average time per call is printed for each writer: 'mock' (a `unittest.mock.Mock`,
+which records every call), 'null' (the writer of `TBLogs.mock`, and of `TBLogs()`),
+'real' (`SummaryWriter`, or its replacement if tensorboard is not installed, writing
+to a temporary directory), and 'buffered' (`TBLogs.buffered` for the 'real' writer,
+excluding the time to write in the background).
+"""
+
+import argparse
+import tempfile
+import time
+import warnings
+from typing import Dict
+from unittest.mock import Mock
+
+from shinyutils.pt import TBLogs
+
+
+def benchmark_writers(n_calls: int) -> Dict[str, float]:
+    # Map writer names to the average time (in seconds) per `add_scalar` call.
+    times = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            tb_logs = TBLogs(tmp_dir)
+        writers = {
+            "mock": Mock(),
+            "null": TBLogs().writer,
+            "real": tb_logs.writer,
+            "buffered": tb_logs.buffered,
+        }
+        for _name, _writer in writers.items():
+            t_start = time.perf_counter()
+            for _i in range(n_calls):
+                _writer.add_scalar("benchmark", 1.0, _i)
+            times[_name] = (time.perf_counter() - t_start) / n_calls
+        tb_logs.close()
+    return times
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    arg_parser.add_argument(
+        "--calls", type=int, default=10000, help="number of calls to time per writer"
+    )
+    args = arg_parser.parse_args()
+
+    for name, secs in benchmark_writers(args.calls).items():
+        print(f"{name}: {secs * 1e6:.2f}us per call")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,25 @@
 """Collection of personal utilities."""
 
-from ._utils import *
+from typing import TYPE_CHECKING
+
 from ._version import __version__
 
-# pylint: disable=undefined-variable
-__all__ = _utils.__all__  # type: ignore
+if TYPE_CHECKING:
+    from ._utils import run_prog
+
+__all__ = ("run_prog",)
+
+
+def __getattr__(name: str):
+    # Import `_utils` (and with it, `corgy` and `logng`) when one of its functions is
+    # first used, so that importing the package, or one of its modules, stays fast.
+    if name in __all__:
+        from . import _utils
+
+        value = globals()[name] = getattr(_utils, name)
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(__all__))
@@ -3,17 +3,27 @@
 import argparse
 import logging
 import os
-from typing import Literal, Optional
+from functools import lru_cache
+from typing import Literal, Optional, Type
 
-try:
-    from rich.logging import RichHandler
-except ImportError:
-    HAS_RICH = False
-else:
-    HAS_RICH = True
+__all__ = ("conf_logging", "is_debug_mode")
 
 
-__all__ = ("conf_logging", "is_debug_mode")
+@lru_cache(maxsize=None)
+def _rich_handler_cls() -> Optional[Type[logging.Handler]]:
+    # `rich` is slow to import, so it is imported when first needed, instead of when
+    # this module is imported.
+    try:
+        from rich.logging import RichHandler
+    except ImportError:
+        return None
+    return RichHandler
+
+
+def __getattr__(name: str):
+    if name == "HAS_RICH":
+        return _rich_handler_cls() is not None
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class _SetLogLevel(argparse.Action):
@@ -82,12 +92,13 @@ def conf_logging(
             log_level = _env_log_level.upper()  # type: ignore
     logging.root.setLevel(log_level)
 
+    rich_handler_cls = _rich_handler_cls()
     if use_colors is None:
-        use_colors = HAS_RICH
+        use_colors = rich_handler_cls is not None
     elif use_colors is True:
-        if not HAS_RICH:
+        if rich_handler_cls is None:
             raise ImportError("cannot enable colored logging: could not import `rich`")
-    inform_about_color = not HAS_RICH
+    inform_about_color = rich_handler_cls is None
 
     # Remove existing root handlers
     for handler in logging.root.handlers:
@@ -96,7 +107,8 @@ def conf_logging(
     # Create root handler
     root_handler: logging.Handler
     if use_colors:
-        root_handler = RichHandler()
+        assert rich_handler_cls is not None
+        root_handler = rich_handler_cls()
         fmt = "%(message)s"
         datefmt = "[%X] "
     else:
@@ -6,7 +6,8 @@ Usage::
     from shinyutils.matwrap import MatWrap as mw
     # Optionally, configure plotting (refer to `MatWrap.configure` docs for details).
     # This is only needed if modifying default configuration, since `configure` is
-    # called upon importing the module.
+    # called when `mpl`/`plt`/`sns` are first accessed, or a `Plot` is first created.
+    # Importing this module does not import `matplotlib` or `seaborn`.
     mw.configure()
 
     fig = mw.plt().figure()
@@ -24,15 +25,39 @@ Usage::
     ...
 """
 
+import copy
+import hashlib
+import io
+import logging
+import os
+import shutil
 from contextlib import AbstractContextManager
 from itertools import cycle, islice
-from typing import Any, Dict, List, Literal, Optional, Tuple
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Literal,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 from corgy import Corgy
 from typing_extensions import Annotated
 
 _WRAPPED_NAMES = ("mpl", "plt", "sns")
-__all__ = ("MatWrap", "PlottingArgs", "Plot") + _WRAPPED_NAMES
+__all__ = (
+    "MatWrap",
+    "PlottingArgs",
+    "PlotCache",
+    "Plot",
+    "PlotSpec",
+    "render_plots",
+) + _WRAPPED_NAMES
 
 mpl: Any
 plt: Any
@@ -95,6 +120,7 @@ class MatWrap(metaclass=_MatWrapMeta):
     _sns = None
 
     _mpl_default_rc: Dict[str, Any]
+    _conf_kwargs: Dict[str, Any] = {}
 
     @classmethod
     def configure(
@@ -116,6 +142,15 @@ class MatWrap(metaclass=_MatWrapMeta):
             backend: Matplotlib backend to override default (pgf).
             rc_extra: Matplotlib params (will overwrite defaults).
         """
+        # Saved for `render_plots`, to configure worker processes the same way.
+        cls._conf_kwargs = {
+            "context": context,
+            "style": style,
+            "font": font,
+            "latex_pkgs": latex_pkgs,
+            "backend": backend,
+            **rc_extra,
+        }
         rc = MatWrap._rc_defaults.copy()
         rc["pgf.preamble"] = [r"\usepackage{fontspec}"]
         rc["pgf.preamble"].append(rf"\setmainfont{{{font}}}")
@@ -234,6 +269,184 @@ class PlottingArgs(Corgy):
         )
 
 
+class PlotCache:
+    """Content-addressed cache of saved plots, for use with `Plot`.
+
+    Args:
+        path: Directory to store cached files in. It is created if it doesn't
+            exist.
+        max_size: Maximum total size (in bytes) of cached files (default: 1 GiB).
+            When it is exceeded, the least recently used files are removed.
+        link: Whether to create hard links to cached files, instead of copying them
+            (default: `False`). If linking fails, files are copied. With links,
+            modifying a saved file in place also modifies the cached file.
+
+    The key for a plot is a hash of the figure's content, matplotlib's rcParams
+    (which include the settings from `MatWrap.configure`, like the pgf preamble and
+    font), the matplotlib version, and the output format. The content is hashed by
+    rendering the figure to SVG (with math text as raw strings), which is much
+    faster than rendering it with the pgf backend. If a file with the same key is
+    in the cache, it is copied to the save path, instead of rendering the figure
+    again.
+
+    Cached files are named by their keys, and the time of last use is tracked with
+    file modification times, so a cache directory can be shared by multiple
+    processes (like the workers of `render_plots`). Layout engines update the
+    positions of axes when a figure is drawn, so the layout is restored after
+    rendering, and saving the same figure again uses the cached file.
+
+    Usage::
+
+        cache = PlotCache("plot_cache", max_size=2**28)
+        with Plot("fig.pdf", cache=cache) as ax:
+            ...
+    """
+
+    def __init__(self, path: str, max_size: int = 2**30, link: bool = False):
+        self.path = path
+        self.max_size = max_size
+        self.link = link
+        os.makedirs(self.path, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f"PlotCache({self.path!r}, max_size={self.max_size})"
+
+    @staticmethod
+    def _save_path_fmt(save_file: str) -> Tuple[str, str]:
+        # Return the path that `savefig` will save to, and the output format.
+        ext = os.path.splitext(save_file)[1]
+        if ext:
+            return save_file, ext[1:].lower()
+        fmt = MatWrap.mpl.rcParams["savefig.format"]
+        return f"{save_file}.{fmt}", fmt
+
+    @staticmethod
+    def _get_layout(fig: Any) -> Tuple[Any, List[Tuple[Any, Any, Any, bool]]]:
+        # Layout engines (like tight layout) update the positions of axes on every
+        # draw, starting from their current positions, so drawing a figure changes
+        # the output of the next draw. The layout is saved before drawing, and
+        # restored after, so that a figure gets the same key when saved again.
+        return copy.copy(fig.subplotpars), [
+            (
+                _ax,
+                _ax.get_position(original=True),
+                _ax.get_position(),
+                _ax.get_in_layout(),
+            )
+            for _ax in fig.get_axes()
+        ]
+
+    @staticmethod
+    def _set_layout(fig: Any, layout: Tuple[Any, List[Tuple[Any, Any, Any, bool]]]):
+        subplotpars, axes_positions = layout
+        fig.subplotpars = copy.copy(subplotpars)
+        for _ax, _original, _active, _in_layout in axes_positions:
+            _ax.set_position(_original, which="original")
+            _ax.set_position(_active, which="active")
+            # `set_position` removes axes from the layout.
+            _ax.set_in_layout(_in_layout)
+
+    def key(self, fig: Any, save_file: str) -> str:
+        """Get the cache key for saving a figure to `save_file`."""
+        fmt = self._save_path_fmt(save_file)[1]
+        svg_buf = io.BytesIO()
+        layout = self._get_layout(fig)
+        # Math text is not parsed, so that markup which only LaTeX understands (like
+        # commands from `latex_pkgs`) is hashed as is, instead of failing in
+        # mathtext. The rc setting only applies to text created while rendering
+        # (like tick labels), so it is also turned off for existing text.
+        texts = [
+            (_text, _text.get_parse_math())
+            for _text in fig.findobj(MatWrap.mpl.text.Text)
+        ]
+        try:
+            for _text, _ in texts:
+                _text.set_parse_math(False)
+            # Fixing the salt makes SVG element ids deterministic.
+            with MatWrap.mpl.rc_context(
+                {"svg.hashsalt": "shinyutils", "text.parse_math": False}
+            ):
+                fig.savefig(svg_buf, format="svg", metadata={"Date": None})
+        finally:
+            for _text, _parse_math in texts:
+                _text.set_parse_math(_parse_math)
+            self._set_layout(fig, layout)
+        hasher = hashlib.sha256(svg_buf.getvalue())
+        rc_items = sorted((_k, repr(_v)) for _k, _v in MatWrap.mpl.rcParams.items())
+        hasher.update(repr((rc_items, MatWrap.mpl.__version__, fmt)).encode())
+        return hasher.hexdigest()
+
+    def save(self, fig: Any, save_file: str) -> bool:
+        """Save a figure to `save_file`, using the cached file if available.
+
+        Returns:
+            `True` if the cached file was used, and `False` if the figure was
+            rendered (and added to the cache).
+
+        If the key can't be computed, the figure is saved without using the cache.
+        """
+        save_path, fmt = self._save_path_fmt(save_file)
+        try:
+            key = self.key(fig, save_file)
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning(
+                "not caching plot `%s`: can't compute key: %s", save_path, e
+            )
+            fig.savefig(save_file)
+            return False
+        cache_file = os.path.join(self.path, f"{key}.{fmt}")
+        try:
+            os.utime(cache_file)
+        except FileNotFoundError:
+            pass
+        else:
+            if os.path.lexists(save_path):
+                os.remove(save_path)
+            if self.link:
+                try:
+                    os.link(cache_file, save_path)
+                    return True
+                except OSError:
+                    pass
+            shutil.copyfile(cache_file, save_path)
+            return True
+
+        layout = self._get_layout(fig)
+        try:
+            fig.savefig(save_file)
+        finally:
+            self._set_layout(fig, layout)
+        # Copy to a temporary file first, so that other processes never see a
+        # partially written cache file.
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        shutil.copyfile(save_path, tmp_file)
+        os.replace(tmp_file, cache_file)
+        self._evict()
+        return False
+
+    def _evict(self):
+        # Remove least recently used files until the cache is within `max_size`.
+        entries = []
+        with os.scandir(self.path) as _it:
+            for _entry in _it:
+                if _entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    _stat = _entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((_stat.st_mtime, _stat.st_size, _entry.path))
+        total_size = sum(_size for _, _size, _ in entries)
+        for _, _size, _path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(_path)
+            except FileNotFoundError:
+                pass
+            total_size -= _size
+
+
 class Plot(AbstractContextManager):
     """Wrapper around a single matplotlib plot.
 
@@ -251,6 +464,8 @@ class Plot(AbstractContextManager):
             `None` (the default), the corresponding axis will not be labeled.
         logxy: Tuple of booleans indicating whether to use a log scale for the x and y
             axis respectively (default: `(False, False)`).
+        cache: Optional `PlotCache` instance to use when saving the plot. If `None`
+            (the default), the plot is always rendered.
 
     Usage::
 
@@ -266,8 +481,10 @@ class Plot(AbstractContextManager):
         sizexy: Optional[Tuple[int, int]] = None,
         labelxy: Tuple[Optional[str], Optional[str]] = (None, None),
         logxy: Tuple[bool, bool] = (False, False),
+        cache: Optional[PlotCache] = None,
     ):
         self.save_file = save_file
+        self.cache = cache
         self.title = title
         self.sizexy = sizexy
         self.labelxy = labelxy
@@ -299,8 +516,116 @@ class Plot(AbstractContextManager):
             self.fig.set_size_inches(*self.sizexy)
 
         if self.save_file is not None:
-            self.fig.savefig(self.save_file)
+            if self.cache is None:
+                self.fig.savefig(self.save_file)
+            else:
+                self.cache.save(self.fig, self.save_file)
         MatWrap.plt.close(self.fig)
 
 
-MatWrap.configure()
+class PlotSpec(NamedTuple):
+    """Specification of a plot, for rendering with `render_plots`.
+
+    Attributes:
+        draw: Callable which draws the plot, given a matplotlib `axis` instance. It
+            must be picklable, like a module level function, or a `functools.partial`
+            wrapping one.
+        save_file: Path to save plot to.
+        title: Optional title for plot.
+        sizexy: Size tuple (width, height) in inches.
+        labelxy: Tuple of labels for the x and y axes respectively.
+        logxy: Tuple of booleans indicating whether to use a log scale for the x and y
+            axis respectively.
+        cache: Optional `PlotCache` instance to use when saving the plot.
+
+    `save_file`, `title`, `sizexy`, `labelxy`, `logxy`, and `cache` are passed to
+    `Plot`.
+    """
+
+    draw: Callable[[Any], Any]
+    save_file: str
+    title: Optional[str] = None
+    sizexy: Optional[Tuple[int, int]] = None
+    labelxy: Tuple[Optional[str], Optional[str]] = (None, None)
+    logxy: Tuple[bool, bool] = (False, False)
+    cache: Optional[PlotCache] = None
+
+
+def _configure_render_worker(conf_kwargs: Dict[str, Any]):
+    MatWrap.configure(**conf_kwargs)
+
+
+def _render_plot(job: Union[PlotSpec, Callable[[], Any]]):
+    if not isinstance(job, PlotSpec):
+        job()
+        return
+    plot = Plot(job.save_file, job.title, job.sizexy, job.labelxy, job.logxy, job.cache)
+    try:
+        with plot as ax:
+            job.draw(ax)
+    except BaseException:
+        # `Plot` doesn't close the figure if there is an error.
+        MatWrap.plt.close(plot.fig)
+        raise
+
+
+def render_plots(
+    jobs: Sequence[Union[PlotSpec, Callable[[], Any]]], workers: Optional[int] = None
+) -> List[Optional[BaseException]]:
+    """Render and save plots in parallel, using a pool of processes.
+
+    Args:
+        jobs: Plots to render. Each job is a `PlotSpec` instance, or a callable with no
+            arguments which creates and saves plots (for example, using `Plot` with
+            `save_file`). Jobs are sent to worker processes, so they must be
+            picklable.
+        workers: Number of worker processes. If `None` (the default), the number of
+            CPUs is used (but not more than the number of jobs). If `0`, jobs are run
+            one after another in the current process.
+
+    Returns:
+        List with an entry for each job: `None` if the job succeeded, and the raised
+        exception if it failed. For exceptions raised in worker processes, the
+        worker's traceback is available as the exception's `__cause__`.
+
+    Matplotlib isn't thread-safe, so plots are rendered in separate processes. Each
+    worker calls `MatWrap.configure` once, with the arguments of the last call to
+    `MatWrap.configure` in the current process (or the defaults, if it has not been
+    called), so plots are rendered with the same settings.
+
+    Usage::
+
+        def draw_curve(ax, xs, ys):
+            ax.plot(xs, ys)
+
+        jobs = [
+            PlotSpec(partial(draw_curve, xs=xs, ys=ys), f"curve{i}.pdf", title=f"{i}")
+            for i, (xs, ys) in enumerate(curves)
+        ]
+        errors = render_plots(jobs)
+        failed = [_job.save_file for _job, _e in zip(jobs, errors) if _e is not None]
+    """
+    errors: List[Optional[BaseException]] = []
+    if workers == 0:
+        for _job in jobs:
+            try:
+                _render_plot(_job)
+            except Exception as e:  # pylint: disable=broad-except
+                errors.append(e)
+            else:
+                errors.append(None)
+        return errors
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    if workers is None:
+        workers = min(os.cpu_count() or 1, len(jobs))
+    with ProcessPoolExecutor(
+        max(workers, 1),
+        initializer=_configure_render_worker,
+        initargs=(MatWrap._conf_kwargs,),
+    ) as executor:
+        futures = [executor.submit(_render_plot, _job) for _job in jobs]
+        for _future in futures:
+            errors.append(_future.exception())
+    return errors
@@ -5,54 +5,279 @@ try:
 except ImportError:
     raise ImportError("shinyutils.pt needs `pytorch`") from None
 
+import atexit
 import inspect
+import io
 import json
 import logging
+import math
+import os
+import queue
+import random
+import re
+import socket
+import sys
+import threading
+import time
 import warnings
 from argparse import Action, ArgumentParser, ArgumentTypeError
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from itertools import chain, islice
 from typing import (
     Any,
     Callable,
+    cast,
+    ContextManager,
+    Dict,
     Iterable,
+    Iterator,
+    List,
+    Literal,
+    NamedTuple,
     Optional,
     Sequence,
+    Set,
     Tuple,
+    Type,
     TYPE_CHECKING,
     Union,
 )
-from unittest.mock import Mock
 
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn.functional as F
 from corgy import Corgy, corgyparser
 from corgy.types import KeyValuePairs, SubClass
 from torch import nn
+from torch.cuda.amp import GradScaler
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim.lr_scheduler import _LRScheduler
 from torch.optim.optimizer import Optimizer
-from torch.utils.data import DataLoader, Dataset, TensorDataset
+from torch.utils.checkpoint import checkpoint
+from torch.utils.data import (
+    DataLoader,
+    Dataset,
+    DistributedSampler,
+    get_worker_info,
+    IterableDataset,
+    Sampler,
+    TensorDataset,
+)
 from typing_extensions import Annotated
 
-try:
-    from tqdm import trange
-except ImportError:
-    warnings.warn("progress bar disabled: could not import `tqdm`", RuntimeWarning)
+if TYPE_CHECKING:
+    import numpy as np
 
-    class trange:  # type: ignore
-        def __init__(self, n, *args, **kwargs):
-            self._range = range(n)
+__all__ = (
+    "DEFAULT_DEVICE",
+    "TensorDiff",
+    "match_tensors",
+    "TensorsReport",
+    "compare_tensors",
+    "GoldenTensors",
+    "PTOpt",
+    "FCNet",
+    "FCNetExport",
+    "FCNetEnsemble",
+    "LazyMetrics",
+    "TrainSummary",
+    "NNTrainer",
+    "TBLogs",
+)
 
-        def __enter__(self):
-            return self
+# `DEFAULT_DEVICE` is set when it is first used (through `_default_device` within
+# this module, and `__getattr__` outside), because checking for CUDA initializes the
+# driver, which is slow. It can be assigned to, to change the device used by this
+# module.
+DEFAULT_DEVICE: torch.device
 
-        def __iter__(self):
-            return iter(self._range)
 
+def _default_device() -> torch.device:
+    device = globals().get("DEFAULT_DEVICE")
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        globals()["DEFAULT_DEVICE"] = device
+    return device
 
-if TYPE_CHECKING:
-    import numpy as np
 
-__all__ = ("DEFAULT_DEVICE", "match_tensors", "PTOpt", "FCNet", "NNTrainer", "TBLogs")
+def __getattr__(name: str):
+    if name == "DEFAULT_DEVICE":
+        return _default_device()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class _NoProgressBar:
+    # Replacement for `tqdm.trange`, used if `tqdm` is not installed.
+
+    def __init__(self, *args, **kwargs):
+        self._range = range(*args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __iter__(self):
+        return iter(self._range)
 
-DEFAULT_DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    def set_postfix(self, *args, **kwargs):
+        pass
+
+
+def _trange(*args, **kwargs):
+    # `tqdm.trange`, with `tqdm` imported when first needed.
+    try:
+        from tqdm import trange
+    except ImportError:
+        warnings.warn("progress bar disabled: could not import `tqdm`", RuntimeWarning)
+        return _NoProgressBar(*args, **kwargs)
+    return trange(*args, **kwargs)
+
+
+class TensorDiff(NamedTuple):
+    """Result of comparing two tensors, from `compare_tensors`.
+
+    Attributes:
+        close: Whether all elements of the tensors are close.
+        max_abs_diff: Maximum absolute difference between elements (`nan` if an
+            element is `nan` in only one tensor).
+        max_rel_diff: Maximum difference relative to the second tensor.
+        worst_index: Index of the element which exceeds the tolerance by the
+            largest amount (`None` if the tensors are close, or if `error` is set).
+        n_mismatched: Number of elements which are not close.
+        error: Description of a mismatch which prevented comparing elements, like
+            tensors with different shapes, or a missing key (`None` otherwise).
+    """
+
+    close: bool
+    max_abs_diff: float = 0.0
+    max_rel_diff: float = 0.0
+    worst_index: Optional[Tuple[int, ...]] = None
+    n_mismatched: int = 0
+    error: Optional[str] = None
+
+
+# Number of elements compared at a time by `match_tensors` and `compare_tensors`.
+_COMPARE_CHUNK_NUMEL = 1 << 20
+
+
+def _flat_chunk(tensor: torch.Tensor, start: int, end: int) -> torch.Tensor:
+    # Elements `start` to `end` of `tensor`, in row-major order, as a 1-d tensor.
+    # Contiguous tensors are sliced without copying. Elements of other tensors (like
+    # transposed or broadcast tensors) are gathered from their storage offsets, so
+    # that only the chunk is copied, whatever the shape and strides.
+    if tensor.is_contiguous():
+        return tensor.view(-1)[start:end]
+    flat_index = torch.arange(start, end, device=tensor.device)
+    storage_index = torch.zeros_like(flat_index)
+    for _size, _stride in zip(reversed(tensor.shape), reversed(tensor.stride())):
+        storage_index.add_(flat_index % _size, alpha=_stride)
+        flat_index.div_(_size, rounding_mode="floor")
+    extent = 1 + sum(
+        (_size - 1) * _stride for _size, _stride in zip(tensor.shape, tensor.stride())
+    )
+    return tensor.as_strided((extent,), (1,))[storage_index]
+
+
+def _iter_flat_chunks(
+    tensor1: torch.Tensor, tensor2: torch.Tensor
+) -> Iterator[Tuple[int, torch.Tensor, torch.Tensor]]:
+    # Yield `(offset, chunk1, chunk2)` for flat chunks of two tensors with the same
+    # shape, in row-major order, with at most `_COMPARE_CHUNK_NUMEL` elements each.
+    numel = tensor1.numel()
+    for _start in range(0, numel, _COMPARE_CHUNK_NUMEL):
+        _end = min(_start + _COMPARE_CHUNK_NUMEL, numel)
+        yield (
+            _start,
+            _flat_chunk(tensor1, _start, _end),
+            _flat_chunk(tensor2, _start, _end),
+        )
+
+
+def _diff_tensors(
+    tensor1: torch.Tensor,
+    tensor2: torch.Tensor,
+    rtol: float,
+    atol: float,
+    equal_nan: bool,
+) -> TensorDiff:
+    # Compare two tensors, like `torch.allclose`, but in chunks, so that temporary
+    # tensors are limited to the chunk size. Chunks of `tensor2` are moved to the
+    # device of `tensor1`.
+    try:
+        shape = torch.broadcast_shapes(tensor1.shape, tensor2.shape)
+    except RuntimeError:
+        return TensorDiff(
+            close=False,
+            error=f"shape mismatch: {tuple(tensor1.shape)} != {tuple(tensor2.shape)}",
+        )
+    tensor1, tensor2 = tensor1.detach().expand(shape), tensor2.detach().expand(shape)
+    # Elements are compared in the promoted dtype of the tensors, with floating point
+    # (and complex) dtypes widened to at least single precision. Integers are
+    # subtracted exactly, and differences are measured in a real dtype, so that
+    # complex differences are compared by their magnitudes.
+    promoted = torch.promote_types(tensor1.dtype, tensor2.dtype)
+    if promoted.is_complex:
+        dtype = torch.complex128 if promoted == torch.complex128 else torch.complex64
+    elif promoted.is_floating_point:
+        dtype = torch.float64 if promoted == torch.float64 else torch.float32
+    else:
+        dtype = torch.int64
+    real_dtype = (
+        torch.float32 if dtype in (torch.float32, torch.complex64) else torch.float64
+    )
+
+    max_abs_diff, max_rel_diff = 0.0, 0.0
+    worst_offset, worst_excess, n_mismatched = None, -math.inf, 0
+    for _offset, _chunk1, _chunk2 in _iter_flat_chunks(tensor1, tensor2):
+        _chunk1 = _chunk1.to(dtype)
+        _chunk2 = _chunk2.to(device=_chunk1.device, dtype=dtype)
+        abs_diff = (_chunk1 - _chunk2).abs().to(real_dtype)
+        equal = _chunk1 == _chunk2
+        if equal_nan:
+            equal |= _chunk1.isnan() & _chunk2.isnan()
+        abs_diff.masked_fill_(equal, 0)
+
+        abs2 = _chunk2.abs().to(real_dtype)
+        rel_diff = abs_diff / abs2
+        rel_diff.masked_fill_(abs_diff == 0, 0)
+        excess = abs_diff - abs2.mul_(rtol).add_(atol)
+        excess.nan_to_num_(nan=math.inf).masked_fill_(equal, -atol)
+        del equal, abs2
+
+        _chunk_max_abs, _chunk_max_rel = abs_diff.max().item(), rel_diff.max().item()
+        max_abs_diff = (
+            _chunk_max_abs
+            if math.isnan(_chunk_max_abs)
+            else max(max_abs_diff, _chunk_max_abs)
+        )
+        max_rel_diff = (
+            _chunk_max_rel
+            if math.isnan(_chunk_max_rel)
+            else max(max_rel_diff, _chunk_max_rel)
+        )
+        n_mismatched += int((excess > 0).sum())
+        _chunk_worst = int(excess.argmax())
+        _chunk_worst_excess = excess[_chunk_worst].item()
+        if _chunk_worst_excess > worst_excess:
+            worst_offset, worst_excess = _offset + _chunk_worst, _chunk_worst_excess
+
+    worst_index = None
+    if worst_offset is not None and n_mismatched > 0:
+        _index = []
+        for _dim in reversed(shape):
+            worst_offset, _i = divmod(worst_offset, _dim)
+            _index.append(_i)
+        worst_index = tuple(reversed(_index))
+    return TensorDiff(
+        close=n_mismatched == 0,
+        max_abs_diff=max_abs_diff,
+        max_rel_diff=max_rel_diff,
+        worst_index=worst_index,
+        n_mismatched=n_mismatched,
+    )
 
 
 def match_tensors(
@@ -62,7 +287,7 @@ def match_tensors(
     atol: float = 1e-5,
     equal_nan: bool = False,
     do_fail: bool = True,
-) -> None:
+) -> bool:
     """Check if two tensors are close to each other.
 
     Args:
@@ -72,28 +297,443 @@ def match_tensors(
         atol: absolute tolerance for comparison.
         equal_nan: whether to treat NaNs as equal to each other.
         do_fail: whether to raise an error if the tensors are not close.
+
+    Returns:
+        `True` if the tensors are close, and `False` otherwise (if `do_fail` is
+        `False`).
+
+    Tensors are compared in chunks, so that memory use doesn't grow with their size.
+    Tensors are compared in their promoted dtype (floating point dtypes are widened
+    to at least `float32`): integer tensors are compared exactly, and complex tensors
+    by the magnitude of their difference. If the tensors are not close, the maximum
+    absolute and relative differences, and the element which most exceeds the
+    tolerance, are logged.
     """
     _log = logging.critical if do_fail else logging.error
-    try:
-        assert torch.allclose(tensor1, tensor2, rtol, atol, equal_nan)
-    except RuntimeError:
-        _log(
-            "shape mismatch when comparing tensors: %s != %s",
-            tensor1.shape,
-            tensor2.shape,
-        )
+    diff = _diff_tensors(tensor1, tensor2, rtol, atol, equal_nan)
+    if diff.error is not None:
+        _log("%s when comparing tensors", diff.error)
         if do_fail:
-            raise
-    except AssertionError:
-        _abs_diff = (tensor1 - tensor2).abs()
-        _rel_diff = _abs_diff / tensor2.abs()
-        _log(
-            "mismatch when comparing tensors: max abs diff: %s, max rel diff: %s",
-            _abs_diff.max(),
-            _rel_diff.max(),
+            raise RuntimeError(f"{diff.error} when comparing tensors")
+        return False
+    if not diff.close:
+        assert diff.worst_index is not None
+        shape = torch.broadcast_shapes(tensor1.shape, tensor2.shape)
+        worst1 = tensor1.expand(shape)[diff.worst_index].item()
+        worst2 = tensor2.expand(shape)[diff.worst_index].item()
+        msg = (
+            f"mismatch when comparing tensors: max abs diff: {diff.max_abs_diff}, "
+            f"max rel diff: {diff.max_rel_diff}, worst element: "
+            f"{list(diff.worst_index)} ({worst1} vs {worst2}), "
+            f"{diff.n_mismatched} of {shape.numel()} elements mismatched"
         )
+        _log(msg)
         if do_fail:
-            raise
+            raise AssertionError(msg)
+        return False
+    return True
+
+
+class TensorsReport(NamedTuple):
+    """Report of comparing nested structures of tensors, from `compare_tensors`.
+
+    Attributes:
+        close: Whether all tensors are close, and the structures match.
+        diffs: Dictionary mapping the path of each compared value (like
+            `layers.0.weight`, or `0.x`) to its `TensorDiff`. Paths of non-tensor
+            values are only included if the values differ.
+    """
+
+    close: bool
+    diffs: Dict[str, TensorDiff]
+
+    @property
+    def mismatches(self) -> Dict[str, TensorDiff]:
+        """Entries of `diffs` which are not close."""
+        return {_k: _v for _k, _v in self.diffs.items() if not _v.close}
+
+
+def compare_tensors(
+    obj1: Any,
+    obj2: Any,
+    rtol: float = 1e-3,
+    atol: float = 1e-5,
+    equal_nan: bool = False,
+) -> TensorsReport:
+    """Compare the tensors in two nested structures, like model `state_dict`s.
+
+    Args:
+        obj1: A tensor, or a (nested) dictionary, list, or tuple, containing
+            tensors and other values.
+        obj2: Structure to compare with `obj1`.
+        rtol: relative tolerance for comparison.
+        atol: absolute tolerance for comparison.
+        equal_nan: whether to treat NaNs as equal to each other.
+
+    Tensors are compared as in `match_tensors`, in chunks. Missing keys, sequences
+    with different lengths, and differing non-tensor values, are reported as
+    `TensorDiff` instances with `error` set. Nothing is logged.
+
+    Example::
+
+        >>> report = compare_tensors(net1.state_dict(), net2.state_dict())
+        >>> report.close
+        False
+        >>> report.mismatches
+        {'layers.0.weight': TensorDiff(close=False, max_abs_diff=0.1, ...)}
+    """
+    diffs: Dict[str, TensorDiff] = {}
+
+    def _compare(_obj1, _obj2, _path):
+        if isinstance(_obj1, torch.Tensor) and isinstance(_obj2, torch.Tensor):
+            diffs[_path] = _diff_tensors(_obj1, _obj2, rtol, atol, equal_nan)
+        elif isinstance(_obj1, dict) and isinstance(_obj2, dict):
+            for _k in list(_obj1) + [_k for _k in _obj2 if _k not in _obj1]:
+                _k_path = f"{_path}.{_k}" if _path else str(_k)
+                if _k not in _obj2:
+                    diffs[_k_path] = TensorDiff(False, error="missing in `obj2`")
+                elif _k not in _obj1:
+                    diffs[_k_path] = TensorDiff(False, error="missing in `obj1`")
+                else:
+                    _compare(_obj1[_k], _obj2[_k], _k_path)
+        elif isinstance(_obj1, (list, tuple)) and isinstance(_obj2, (list, tuple)):
+            if len(_obj1) != len(_obj2):
+                diffs[_path] = TensorDiff(
+                    False, error=f"length mismatch: {len(_obj1)} != {len(_obj2)}"
+                )
+                return
+            for _i, (_v1, _v2) in enumerate(zip(_obj1, _obj2)):
+                _compare(_v1, _v2, f"{_path}.{_i}" if _path else str(_i))
+        elif type(_obj1) is not type(_obj2):
+            diffs[_path] = TensorDiff(
+                False,
+                error=f"type mismatch: `{type(_obj1).__name__}` != "
+                f"`{type(_obj2).__name__}`",
+            )
+        elif _obj1 != _obj2:
+            diffs[_path] = TensorDiff(
+                False, error=f"value mismatch: {_obj1!r} != {_obj2!r}"
+            )
+
+    _compare(obj1, obj2, "")
+    return TensorsReport(all(_v.close for _v in diffs.values()), diffs)
+
+
+class GoldenTensors:
+    """Directory of reference ('golden') tensors for numerical regression tests.
+
+    Args:
+        path: Path to the directory. It is created if it doesn't exist.
+        update: If `True`, `check` stores the given tensors as the new references,
+            instead of comparing against existing ones.
+
+    Each tensor is saved to its own `.npy` file, and an `index.json` file maps names
+    to files. Only the index is read when the instance is created. Tensors are
+    opened as memory-mapped arrays when they are checked or loaded, and comparisons
+    read them in chunks, so the stored tensors are never loaded into memory as a
+    whole.
+
+    Usage::
+
+        golden = GoldenTensors("tests/golden", update=args.update_golden)
+        golden.check("fcnet.out", net(x))  # raises if the output changed
+        golden.compare(net.state_dict(), prefix="fcnet.").mismatches
+    """
+
+    __metavar__ = "dir"
+    _INDEX_FILE = "index.json"
+
+    def __init__(self, path: Union[str, os.PathLike], update: bool = False):
+        self.path = os.fspath(path)
+        self.update = update
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            with open(
+                os.path.join(self.path, self._INDEX_FILE), encoding="utf-8"
+            ) as _f:
+                self._index: Dict[str, Dict[str, Any]] = json.load(_f)
+        except FileNotFoundError:
+            self._index = {}
+
+    def __repr__(self) -> str:
+        return f"GoldenTensors({self.path!r})"
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _write_index(self):
+        # Write to a temporary file first, so that an interrupted write doesn't
+        # corrupt the existing index.
+        index_path = os.path.join(self.path, self._INDEX_FILE)
+        with open(index_path + ".tmp", "w", encoding="utf-8") as _f:
+            json.dump(self._index, _f, indent=2, sort_keys=True)
+        os.replace(index_path + ".tmp", index_path)
+
+    def save(self, name: str, tensor: torch.Tensor):
+        """Store a tensor as the reference for `name`, replacing any existing one."""
+        import numpy as np
+
+        if name in self._index:
+            fname = self._index[name]["file"]
+        else:
+            stem = re.sub(r"[^\w.-]", "_", name)
+            used = {_entry["file"] for _entry in self._index.values()}
+            fname, _i = f"{stem}.npy", 0
+            while fname in used:
+                _i += 1
+                fname = f"{stem}-{_i}.npy"
+
+        tensor = tensor.detach().cpu()
+        dtype = tensor.dtype
+        if dtype == torch.bfloat16:
+            # numpy doesn't have bfloat16, so store the raw 16-bit values.
+            tensor = tensor.view(torch.int16)
+        tmp_path = os.path.join(self.path, fname + ".tmp")
+        with open(tmp_path, "wb") as _f:
+            np.save(_f, tensor.numpy())
+        os.replace(tmp_path, os.path.join(self.path, fname))
+        self._index[name] = {
+            "file": fname,
+            "dtype": str(dtype).replace("torch.", ""),
+            "shape": list(tensor.shape),
+        }
+        self._write_index()
+
+    def _shape_error(self, name: str, tensor: torch.Tensor) -> Optional[str]:
+        # Describe the mismatch between the shape of `tensor`, and the shape recorded
+        # for `name` in the index (`None` if the shapes are the same).
+        shape, golden_shape = tuple(tensor.shape), tuple(self._index[name]["shape"])
+        if shape != golden_shape:
+            return f"shape mismatch: {shape} != {golden_shape}"
+        return None
+
+    def load(self, name: str) -> torch.Tensor:
+        """Get the reference tensor for `name`, as a memory-mapped CPU tensor.
+
+        The tensor's data is read from disk on access. Changes to the tensor are not
+        written back to disk.
+        """
+        import numpy as np
+
+        try:
+            entry = self._index[name]
+        except KeyError:
+            raise KeyError(f"no golden tensor named `{name}` in {self.path}") from None
+        # Copy-on-write mode gives a writable array, which `torch.from_numpy` needs.
+        array = np.load(os.path.join(self.path, entry["file"]), mmap_mode="c")
+        tensor = torch.from_numpy(array)
+        if entry["dtype"] == "bfloat16":
+            tensor = tensor.view(torch.bfloat16)
+        return tensor
+
+    def check(
+        self,
+        name: str,
+        tensor: torch.Tensor,
+        rtol: float = 1e-3,
+        atol: float = 1e-5,
+        equal_nan: bool = False,
+        do_fail: bool = True,
+    ) -> bool:
+        """Check if a tensor is close to the reference for `name`.
+
+        Args:
+            name: Name of the reference tensor.
+            tensor: Tensor to check.
+            rtol, atol, equal_nan, do_fail: Passed to `match_tensors`.
+
+        Returns:
+            Result of `match_tensors`. If `update` is `True`, `tensor` is stored as
+            the reference, and `True` is returned.
+
+        If `update` is `False`, and there is no tensor named `name`, `KeyError` is
+        raised. The shape of `tensor` is checked against the shape of the reference
+        before comparing values (tensors are not broadcast), and a shape mismatch is
+        handled like a shape mismatch in `match_tensors`.
+        """
+        if self.update:
+            self.save(name, tensor)
+            return True
+        golden = self.load(name)
+        error = self._shape_error(name, tensor)
+        if error is not None:
+            _log = logging.critical if do_fail else logging.error
+            _log("%s when comparing with golden tensor `%s`", error, name)
+            if do_fail:
+                raise RuntimeError(
+                    f"{error} when comparing with golden tensor `{name}`"
+                )
+            return False
+        return match_tensors(tensor, golden, rtol, atol, equal_nan, do_fail=do_fail)
+
+    def compare(
+        self,
+        tensors: Dict[str, torch.Tensor],
+        prefix: str = "",
+        rtol: float = 1e-3,
+        atol: float = 1e-5,
+        equal_nan: bool = False,
+    ) -> TensorsReport:
+        """Compare a dictionary of tensors, like a `state_dict`, with the references.
+
+        Args:
+            tensors: Dictionary mapping names to tensors.
+            prefix: String prepended to names in `tensors` to get reference names.
+            rtol, atol, equal_nan: Passed to `compare_tensors`.
+
+        Returns:
+            `TensorsReport` instance, with paths given by names in `tensors`. Names
+            with no reference tensor, or with a different shape than the reference,
+            are reported with `error` set. If `update` is `True`, the tensors are
+            stored as the references, and the report is empty.
+
+        The reference tensors are loaded one at a time, and are not broadcast.
+        """
+        if self.update:
+            for _name, _tensor in tensors.items():
+                self.save(prefix + _name, _tensor)
+            return TensorsReport(True, {})
+
+        diffs: Dict[str, TensorDiff] = {}
+        for _name, _tensor in tensors.items():
+            if prefix + _name not in self._index:
+                diffs[_name] = TensorDiff(False, error="missing in golden tensors")
+            elif (error := self._shape_error(prefix + _name, _tensor)) is not None:
+                diffs[_name] = TensorDiff(False, error=error)
+            else:
+                diffs[_name] = _diff_tensors(
+                    _tensor, self.load(prefix + _name), rtol, atol, equal_nan
+                )
+        return TensorsReport(all(_v.close for _v in diffs.values()), diffs)
+
+
+class _CompactTensor:
+    # Compact copy of a floating point tensor: in 'bf16', in 'int8' blockwise
+    # quantized form, or on 'cpu'. In 'int8' form, each block of values is scaled by
+    # its maximum absolute value, and the square roots of the scaled magnitudes are
+    # stored as signed 8 bit codes. The square root mapping keeps small values (like
+    # Adam's second moments) from collapsing to 0, and non-zero values are never
+    # rounded to 0.
+    BLOCK_SIZE = 256
+
+    def __init__(self, tensor: torch.Tensor, mode: str):
+        self.mode = mode
+        self.dtype, self.shape, self.device = tensor.dtype, tensor.shape, tensor.device
+        if mode == "bf16":
+            self.data = tensor.to(torch.bfloat16)
+        elif mode == "cpu":
+            self.data = tensor.to("cpu")
+        else:
+            flat = tensor.detach().flatten().float()
+            flat = F.pad(flat, (0, -len(flat) % self.BLOCK_SIZE))
+            blocks = flat.view(-1, self.BLOCK_SIZE)
+            self.absmax = blocks.abs().amax(dim=1, keepdim=True)
+            mags = (blocks.abs() / self.absmax.clamp_min(1e-30)).sqrt_().mul_(127)
+            mags = torch.where(blocks != 0, mags.round_().clamp_(1, 127), mags)
+            self.data = (mags * blocks.sign()).to(torch.int8)
+
+    def expand(self, device: Optional[torch.device] = None) -> torch.Tensor:
+        if device is None:
+            device = self.device
+        if self.mode != "int8":
+            return self.data.to(device=device, dtype=self.dtype)
+        codes = self.data.to(device).float().div_(127)
+        blocks = codes.abs() * codes * self.absmax.to(device)
+        return blocks.flatten()[: self.shape.numel()].view(self.shape).to(self.dtype)
+
+
+class _CompactOptimState:
+    # Keeps the per-weight state tensors of `optimizer` (like Adam's moments) as
+    # `_CompactTensor` objects between steps. `step` expands the state for chunks of
+    # weights, and steps the optimizer on each chunk (by hiding the gradients of
+    # other weights, which optimizers skip), so that only one chunk of the state is
+    # in full precision at a time. `param_groups` is exposed, so that this can be
+    # passed to `GradScaler.step`.
+    CHUNK_NUMEL = 1 << 22
+
+    def __init__(self, optimizer: Optimizer, mode: str):
+        self.optimizer = optimizer
+        self.mode = mode
+        self.compact(self._weights())
+
+    @property
+    def param_groups(self) -> List[Dict[str, Any]]:
+        return self.optimizer.param_groups
+
+    def _weights(self) -> List[torch.Tensor]:
+        return [_w for _group in self.param_groups for _w in _group["params"]]
+
+    def compact(self, weights: Iterable[torch.Tensor]):
+        for _w in weights:
+            if _w not in self.optimizer.state:
+                continue
+            _state = self.optimizer.state[_w]
+            for _k, _v in _state.items():
+                if (
+                    isinstance(_v, torch.Tensor)
+                    and _v.is_floating_point()
+                    and _v.shape == _w.shape
+                ):
+                    _state[_k] = _CompactTensor(_v, self.mode)
+
+    def expand(
+        self, weights: Iterable[torch.Tensor], device: Optional[torch.device] = None
+    ):
+        for _w in weights:
+            if _w not in self.optimizer.state:
+                continue
+            _state = self.optimizer.state[_w]
+            for _k, _v in _state.items():
+                if isinstance(_v, _CompactTensor):
+                    _state[_k] = _v.expand(device)
+
+    def step(self):
+        weights = [_w for _w in self._weights() if _w.grad is not None]
+        grads = [_w.grad for _w in weights]
+        chunks: List[List[Tuple[torch.Tensor, torch.Tensor]]] = [[]]
+        chunk_numel = 0
+        for _w, _grad in zip(weights, grads):
+            if chunk_numel >= self.CHUNK_NUMEL:
+                chunks.append([])
+                chunk_numel = 0
+            chunks[-1].append((_w, _grad))
+            chunk_numel += _w.numel()
+
+        try:
+            for _w in weights:
+                _w.grad = None
+            for _chunk in chunks:
+                chunk_weights = [_w for _w, _ in _chunk]
+                for _w, _grad in _chunk:
+                    _w.grad = _grad
+                self.expand(chunk_weights)
+                self.optimizer.step()
+                self.compact(chunk_weights)
+                for _w in chunk_weights:
+                    _w.grad = None
+        finally:
+            for _w, _grad in zip(weights, grads):
+                _w.grad = _grad
+
+    def state_dict(self) -> Dict[str, Any]:
+        # Optimizer state dict, with state tensors expanded on CPU.
+        state = self.optimizer.state_dict()
+        state["state"] = {
+            _i: {
+                _k: _v.expand(torch.device("cpu"))
+                if isinstance(_v, _CompactTensor)
+                else _v
+                for _k, _v in _w_state.items()
+            }
+            for _i, _w_state in state["state"].items()
+        }
+        return state
 
 
 class PTOpt(Corgy):
@@ -108,7 +748,7 @@ class PTOpt(Corgy):
         >>> opt.step()
     """
 
-    __slots__ = ("optimizer", "lr_scheduler")
+    __slots__ = ("optimizer", "lr_scheduler", "_compact_state")
 
     class _OptimizerSubClass(SubClass[Optimizer]):
         @classmethod
@@ -135,6 +775,21 @@ class PTOpt(Corgy):
         KeyValuePairs, "arguments for the learning rate scheduler"
     ] = KeyValuePairs("")
 
+    optim_impl: Annotated[
+        Literal["auto", "foreach", "fused", "single"],
+        "optimizer implementation: 'foreach' and 'fused' update all weights with a "
+        "few kernels, 'single' updates weights one at a time, and 'auto' uses "
+        "'foreach' if supported and all weights are on CUDA, else the optimizer "
+        "default",
+    ] = "auto"
+
+    optim_state: Annotated[
+        Literal["full", "bf16", "int8", "cpu"],
+        "how to store optimizer state between steps: 'bf16' and 'int8' (blockwise "
+        "quantized) reduce its memory by 2x and ~4x, and 'cpu' offloads it to CPU "
+        "memory",
+    ] = "full"
+
     @corgyparser("optim_params")
     @corgyparser("lr_sched_params")
     @staticmethod
@@ -149,10 +804,52 @@ class PTOpt(Corgy):
         super().__init__(**kwargs)
         self.optimizer = None
         self.lr_scheduler = None
+        self._compact_state = None
+
+    @property
+    def _optim_type(self) -> Type[Optimizer]:
+        # The optimizer class (`optim_cls` can be a `SubClass` instance).
+        return getattr(self.optim_cls, "_subcls", self.optim_cls)  # type: ignore
+
+    def _impl_params(
+        self, impl: str, weights: Sequence[torch.Tensor]
+    ) -> Dict[str, bool]:
+        # Get optimizer arguments for the implementation `impl`, checking that it is
+        # supported by `optim_cls`.
+        supported = inspect.signature(self._optim_type).parameters
+        if impl != "auto":
+            if "foreach" in self.optim_params or "fused" in self.optim_params:
+                raise ValueError(
+                    "`foreach`/`fused` optimizer params conflict with `optim_impl`"
+                )
+            if impl in ("foreach", "fused") and impl not in supported:
+                raise ValueError(
+                    f"`{self._optim_type.__name__}` does not support `{impl}`"
+                )
+
+        if impl == "auto":
+            if (
+                "foreach" in supported
+                and "foreach" not in self.optim_params
+                and "fused" not in self.optim_params
+                and weights
+                and all(_w.is_cuda for _w in weights)
+            ):
+                return {"foreach": True}
+            return {}
+        if impl == "single":
+            return {_k: False for _k in ("foreach", "fused") if _k in supported}
+        return {impl: True}
 
     def set_weights(self, weights: Iterable[torch.Tensor]):
         """Set weights of underlying optimizer."""
-        self.optimizer = self.optim_cls(weights, **self.optim_params)
+        weights = list(weights)
+        self.optimizer = self.optim_cls(
+            weights, **self.optim_params, **self._impl_params(self.optim_impl, weights)
+        )
+        self._compact_state = None
+        if self.optim_state != "full":
+            self._compact_state = _CompactOptimState(self.optimizer, self.optim_state)
         if self.lr_sched_cls is not None:
             self.lr_scheduler = self.lr_sched_cls(  # pylint: disable=not-callable
                 self.optimizer, **self.lr_sched_params
@@ -188,13 +885,108 @@ class PTOpt(Corgy):
         self._ensure_initialized()
         self.optimizer.zero_grad()
 
-    def step(self):
-        """Call `step` on underlying optimizer, and lr scheduler (if present)."""
+    def state_dict(self) -> Dict[str, Any]:
+        """Get the state of the optimizer, and lr scheduler (if present).
+
+        If `optim_state` is not 'full', the optimizer state tensors are expanded to
+        full precision, on CPU, so that the state can be loaded with any
+        `optim_state`.
+        """
+        self._ensure_initialized()
+        if self._compact_state is not None:
+            state = {"optimizer": self._compact_state.state_dict()}
+        else:
+            state = {"optimizer": self.optimizer.state_dict()}
+        if self.lr_scheduler is not None:
+            state["lr_scheduler"] = self.lr_scheduler.state_dict()
+        return state
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        """Load state returned by `state_dict`."""
+        self._ensure_initialized()
+        self.optimizer.load_state_dict(state["optimizer"])
+        if self._compact_state is not None:
+            self._compact_state.compact(self._compact_state._weights())
+        if self.lr_scheduler is not None:
+            self.lr_scheduler.load_state_dict(state["lr_scheduler"])
+
+    def step(self, grad_scaler: Optional[GradScaler] = None):
+        """Call `step` on underlying optimizer, and lr scheduler (if present).
+
+        Args:
+            grad_scaler: Optional `GradScaler` instance used to scale the loss. If
+                given, the optimizer step is taken through the scaler (which skips
+                steps with non-finite gradients), and the scale is updated.
+        """
         self._ensure_initialized()
-        self.optimizer.step()
+        stepper: Any = self.optimizer
+        if self._compact_state is not None:
+            stepper = self._compact_state
+        if grad_scaler is not None:
+            grad_scaler.step(stepper)
+            grad_scaler.update()
+        else:
+            stepper.step()
         if self.lr_scheduler is not None:
             self.lr_scheduler.step()
 
+    def benchmark_impls(
+        self, weights: Iterable[torch.Tensor], n_steps: int = 100
+    ) -> Dict[str, float]:
+        """Time optimizer steps with each implementation supported by `optim_cls`.
+
+        Args:
+            weights: Weights to time steps for, like `model.parameters()`. Copies of
+                the weights, with random gradients, are used, so the weights, and
+                this instance, are not modified.
+            n_steps: Number of steps to time for each implementation (after 5 warm
+                up steps).
+
+        Returns:
+            Dictionary mapping implementation names (`single`, `foreach`, `fused`)
+            to the mean time per step, in seconds. Implementations which fail for
+            the given weights (like `fused` on CPU) are skipped.
+
+        Example::
+
+            >>> opt = PTOpt(optim_cls=Adam)
+            >>> opt.benchmark_impls(net.parameters())
+            {'single': 0.0012, 'foreach': 0.0004}
+        """
+        optim_name = self._optim_type.__name__
+        step_params = inspect.signature(self._optim_type.step).parameters
+        closure_param = step_params.get("closure")
+        if closure_param is not None and closure_param.default is closure_param.empty:
+            raise ValueError(f"can't benchmark `{optim_name}`: step needs a closure")
+        weights = [_w.detach().clone().requires_grad_() for _w in weights]
+        for _w in weights:
+            _w.grad = torch.randn_like(_w)
+        sync = torch.cuda.synchronize if any(_w.is_cuda for _w in weights) else None
+
+        step_times = {}
+        for impl in ("single", "foreach", "fused"):
+            try:
+                optimizer = self.optim_cls(
+                    weights, **self.optim_params, **self._impl_params(impl, weights)
+                )
+                for _ in range(5):
+                    optimizer.step()
+            except (ValueError, RuntimeError) as e:
+                logging.info("skipping `%s` implementation: %s", impl, e)
+                continue
+            if sync is not None:
+                sync()
+            t_start = time.perf_counter()
+            for _ in range(n_steps):
+                optimizer.step()
+            if sync is not None:
+                sync()
+            step_times[impl] = (time.perf_counter() - t_start) / n_steps
+            logging.info(
+                "`%s` %s step: %.3gms", optim_name, impl, 1000 * step_times[impl]
+            )
+        return step_times
+
     @staticmethod
     def add_help_args_to_parser(
         base_parser: ArgumentParser, group_title: Optional[str] = "pytorch help"
@@ -250,12 +1042,39 @@ class PTOpt(Corgy):
         )
 
 
+# In-place versions of activation functions, used by `FCNet` with `fused_act`. The
+# backward passes of these only need their outputs, so they can overwrite inputs.
+_INPLACE_ACTS: Dict[Callable[..., torch.Tensor], Callable[..., torch.Tensor]] = {
+    F.relu: torch.relu_,
+    torch.relu: torch.relu_,
+    F.tanh: torch.tanh_,
+    torch.tanh: torch.tanh_,
+    F.sigmoid: torch.sigmoid_,
+    torch.sigmoid: torch.sigmoid_,
+    F.elu: F.elu_,
+    F.leaky_relu: F.leaky_relu_,
+    F.hardtanh: F.hardtanh_,
+}
+
+
+# Activation function arguments of `FCNet` and `FCNetEnsemble`, which are parsed from
+# names of functions in `torch.nn.functional`.
+_ActType = Callable[..., torch.Tensor]
+_ActType.__metavar__ = "fun"  # type: ignore
+
+
+def _parse_activation(s: str) -> _ActType:
+    try:
+        return getattr(F, s)
+    except AttributeError:
+        raise ArgumentTypeError(
+            f"`torch.nn.functional` has no attribute `{s}`"
+        ) from None
+
+
 class FCNet(Corgy, nn.Module):
     """Fully connected PyTorch network."""
 
-    _ActType = Callable[..., torch.Tensor]
-    _ActType.__metavar__ = "fun"  # type: ignore
-
     __slots__ = ("__dict__",)
 
     in_dim: Annotated[int, "number of input features"]
@@ -265,17 +1084,20 @@ class FCNet(Corgy, nn.Module):
     out_act: Annotated[
         Optional[_ActType], "activation function for output layer"
     ] = None
-
-    @corgyparser("hidden_act")
-    @corgyparser("out_act")
-    @staticmethod
-    def _activation_function(s: str) -> _ActType:
-        try:
-            return getattr(F, s)
-        except AttributeError:
-            raise ArgumentTypeError(
-                f"`torch.nn.functional` has no attribute `{s}`"
-            ) from None
+    ckpt_segments: Annotated[
+        int,
+        "number of segments to split layers into for activation checkpointing in "
+        "training (0 or 1 to disable)",
+    ] = 0
+    fused_act: Annotated[
+        bool,
+        "whether to apply the hidden activation in place on the output of each "
+        "linear layer (if it has an in-place version)",
+    ] = False
+
+    _activation_function = corgyparser("hidden_act")(
+        corgyparser("out_act")(_parse_activation)
+    )
 
     def __init__(self, **kwargs):
         nn.Module.__init__(self)
@@ -285,61 +1107,1148 @@ class FCNet(Corgy, nn.Module):
             [nn.Linear(ls, ls_n) for ls, ls_n in zip(layer_sizes, layer_sizes[1:])]
         )
 
+    def _forward_layers(self, x: torch.Tensor, start: int, end: int) -> torch.Tensor:
+        # Forward `x` through `layers[start:end]`, with the hidden activation after
+        # each layer except the last layer of the network.
+        hidden_act = self.hidden_act
+        if self.fused_act:
+            hidden_act = _INPLACE_ACTS.get(hidden_act, hidden_act)
+        for _i in range(start, end):
+            x = self.layers[_i](x)
+            if _i < len(self.layers) - 1:
+                x = hidden_act(x)
+        return x
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """Forward a tensor through the network, and return the result.
 
         Args:
             x: Input tensor of shape `(batch_size, in_dim)`.
+
+        If `ckpt_segments` is more than 1, and gradients are being computed in
+        training mode, the layers are split into that many segments, and the
+        activations inside all but the last segment are recomputed in the backward
+        pass instead of being stored. This reduces memory use from linear in the
+        number of layers to linear in the number of segments, at the cost of an
+        extra forward pass.
+
+        If `fused_act` is `True`, and `hidden_act` is one of `relu`, `tanh`,
+        `sigmoid`, `elu`, `leaky_relu`, or `hardtanh` (from `torch` or
+        `torch.nn.functional`), the activation overwrites the output of each linear
+        layer instead of allocating a new tensor. Outputs and gradients are the same
+        with both options.
+        """
+        n_layers = len(self.layers)
+        n_segments = min(self.ckpt_segments, n_layers)
+        if n_segments > 1 and self.training and torch.is_grad_enabled():
+            bounds = [_s * n_layers // n_segments for _s in range(n_segments + 1)]
+            for start, end in zip(bounds[:-2], bounds[1:-1]):
+                x = checkpoint(self._forward_layers, x, start, end, use_reentrant=False)
+            x = self._forward_layers(x, bounds[-2], n_layers)
+        else:
+            x = self._forward_layers(x, 0, n_layers)
+        if self.out_act is not None:
+            x = self.out_act(x)  # pylint: disable=not-callable
+        return x
+
+    def export(
+        self,
+        x: torch.Tensor,
+        quantize: bool = False,
+        path: Optional[str] = None,
+        rtol: float = 1e-3,
+        atol: float = 1e-5,
+    ) -> "FCNetExport":
+        """Export the network for CPU inference, as a frozen TorchScript module.
+
+        Args:
+            x: Example input tensor of shape `(batch_size, in_dim)`, used to trace
+                the network, and to measure the difference between the outputs of
+                the exported module and the float network.
+            quantize: Whether to quantize the weights of the linear layers to int8,
+                with dynamic quantization (activations are quantized on the fly).
+            path: Optional file to save the exported module to, with
+                `torch.jit.save`. The output differences are saved with it, as an
+                extra file named `accuracy.json`.
+            rtol, atol: Tolerances for counting mismatched outputs, as in
+                `match_tensors`.
+
+        The network itself is not modified: a copy on CPU, in eval mode, is traced
+        and frozen. The outputs of the exported module on `x` are compared with the
+        float outputs like in `match_tensors`, and the maximum absolute and relative
+        differences, and the number of mismatched outputs, are logged, and returned
+        with the module.
+        """
+        net = FCNet(
+            in_dim=self.in_dim,
+            out_dim=self.out_dim,
+            hidden_dims=self.hidden_dims,
+            hidden_act=self.hidden_act,
+            out_act=self.out_act,
+        )
+        net.load_state_dict({_k: _v.cpu() for _k, _v in self.state_dict().items()})
+        net.eval()
+        x = x.detach().cpu()
+        with torch.no_grad():
+            expected = net(x)
+            if quantize:
+                torch.ao.quantization.quantize_dynamic(
+                    net, {nn.Linear}, dtype=torch.qint8, inplace=True
+                )
+            module = torch.jit.freeze(torch.jit.trace(net, x))
+            actual = module(x)
+
+        diff = _diff_tensors(actual, expected, rtol, atol, equal_nan=False)
+        exported = FCNetExport(
+            module=module,
+            quantized=quantize,
+            max_abs_diff=diff.max_abs_diff,
+            max_rel_diff=diff.max_rel_diff,
+            n_mismatched=diff.n_mismatched,
+        )
+        logging.info(
+            "exported `FCNet`%s: max abs diff: %s, max rel diff: %s, "
+            "%d of %d outputs mismatched",
+            " (int8)" if quantize else "",
+            exported.max_abs_diff,
+            exported.max_rel_diff,
+            exported.n_mismatched,
+            expected.numel(),
+        )
+        if path is not None:
+            accuracy = {
+                "quantized": exported.quantized,
+                "max_abs_diff": exported.max_abs_diff,
+                "max_rel_diff": exported.max_rel_diff,
+                "n_mismatched": exported.n_mismatched,
+            }
+            torch.jit.save(
+                module, path, _extra_files={"accuracy.json": json.dumps(accuracy)}
+            )
+        return exported
+
+
+class FCNetExport(NamedTuple):
+    """Network exported with `FCNet.export`.
+
+    Attributes:
+        module: Frozen TorchScript module.
+        quantized: Whether the linear layers are quantized to int8.
+        max_abs_diff: Maximum absolute difference between the outputs of `module`,
+            and the float network, on the example input.
+        max_rel_diff: Maximum relative difference between the outputs of `module`,
+            and the float network, on the example input.
+        n_mismatched: Number of outputs of `module` on the example input which are
+            not close to the outputs of the float network.
+    """
+
+    module: torch.jit.ScriptModule
+    quantized: bool
+    max_abs_diff: float
+    max_rel_diff: float
+    n_mismatched: int
+
+
+class FCNetEnsemble(Corgy, nn.Module):
+    """Ensemble of fully connected networks with the same shape, run together.
+
+    The weights of the members are stacked, so that each layer is computed for all
+    members with a single batched matrix multiply. Outputs have shape
+    `(n_members, batch_size, out_dim)`, and can be trained with a per member loss
+    using `ensemble_loss`. Members can be extracted as `FCNet` instances with
+    `member`, and an ensemble can be created from existing networks with
+    `from_members`.
+
+    Usage::
+
+        >>> ens = FCNetEnsemble(in_dim=4, out_dim=1, hidden_dims=[32], n_members=8)
+        >>> trainer.train(ens, FCNetEnsemble.ensemble_loss(F.mse_loss))
+        >>> net = ens.member(0)  # `FCNet` instance
+    """
+
+    __slots__ = ("__dict__",)
+
+    in_dim: Annotated[int, "number of input features"]
+    out_dim: Annotated[int, "number of output features"]
+    hidden_dims: Annotated[Sequence[int], "hidden layer dimensions"]
+    n_members: Annotated[int, "number of networks in the ensemble"]
+    hidden_act: Annotated[_ActType, "activation function for hidden layers"] = F.relu
+    out_act: Annotated[
+        Optional[_ActType], "activation function for output layer"
+    ] = None
+
+    _activation_function = corgyparser("hidden_act")(
+        corgyparser("out_act")(_parse_activation)
+    )
+
+    def __init__(self, **kwargs):
+        nn.Module.__init__(self)
+        Corgy.__init__(self, **kwargs)
+        layer_sizes = [self.in_dim] + list(self.hidden_dims) + [self.out_dim]
+        # Members are initialized like `nn.Linear` layers. Weights are stored
+        # transposed, with shape `(n_members, in_features, out_features)`, and
+        # biases with shape `(n_members, 1, out_features)`, for use with `baddbmm`.
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for ls, ls_n in zip(layer_sizes, layer_sizes[1:]):
+            linears = [nn.Linear(ls, ls_n) for _ in range(self.n_members)]
+            self.weights.append(
+                nn.Parameter(torch.stack([_l.weight.detach().t() for _l in linears]))
+            )
+            self.biases.append(
+                nn.Parameter(torch.stack([_l.bias.detach()[None] for _l in linears]))
+            )
+
+    @classmethod
+    def from_members(cls, nets: Sequence[FCNet]) -> "FCNetEnsemble":
+        """Create an ensemble with copies of the weights of networks.
+
+        Args:
+            nets: `FCNet` instances with the same dimensions and activations.
+        """
+        net0 = nets[0]
+        for net in nets[1:]:
+            if (
+                net.in_dim != net0.in_dim
+                or net.out_dim != net0.out_dim
+                or list(net.hidden_dims) != list(net0.hidden_dims)
+                or net.hidden_act is not net0.hidden_act
+                or net.out_act is not net0.out_act
+            ):
+                raise ValueError("ensemble members must have the same configuration")
+        ens = cls(
+            in_dim=net0.in_dim,
+            out_dim=net0.out_dim,
+            hidden_dims=net0.hidden_dims,
+            n_members=len(nets),
+            hidden_act=net0.hidden_act,
+            out_act=net0.out_act,
+        )
+        with torch.no_grad():
+            for _i, (weight, bias) in enumerate(zip(ens.weights, ens.biases)):
+                weight.copy_(torch.stack([_n.layers[_i].weight.t() for _n in nets]))
+                bias.copy_(torch.stack([_n.layers[_i].bias[None] for _n in nets]))
+        return ens.to(next(net0.parameters()).device)
+
+    def member(self, k: int) -> FCNet:
+        """Get a copy of a member of the ensemble, as an `FCNet` instance.
+
+        Args:
+            k: Index of the member, in `[0, n_members)`.
         """
-        for layer in self.layers[:-1]:
-            x = self.hidden_act(layer(x))
-        x = self.layers[-1](x)
+        net = FCNet(
+            in_dim=self.in_dim,
+            out_dim=self.out_dim,
+            hidden_dims=self.hidden_dims,
+            hidden_act=self.hidden_act,
+            out_act=self.out_act,
+        ).to(self.weights[0].device)
+        with torch.no_grad():
+            for layer, weight, bias in zip(net.layers, self.weights, self.biases):
+                layer.weight.copy_(weight[k].t())
+                layer.bias.copy_(bias[k, 0])
+        return net
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """Forward a tensor through all members, and return the stacked results.
+
+        Args:
+            x: Input tensor of shape `(batch_size, in_dim)`, which is passed to every
+                member, or `(n_members, batch_size, in_dim)`, with separate inputs
+                for each member.
+        """
+        if x.dim() == 2:
+            x = x.expand(self.n_members, *x.shape)
+        n_layers = len(self.weights)
+        for _i, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            x = torch.baddbmm(bias, x, weight)
+            if _i < n_layers - 1:
+                x = self.hidden_act(x)
         if self.out_act is not None:
             x = self.out_act(x)  # pylint: disable=not-callable
         return x
 
+    @staticmethod
+    def ensemble_loss(
+        loss_fn: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+        shared_targets: bool = True,
+    ) -> Callable[[torch.Tensor, torch.Tensor], torch.Tensor]:
+        """Get a loss function for training an ensemble with a per member loss.
+
+        Args:
+            loss_fn: Loss function for a single network, mapping output and target
+                tensors to a scalar loss.
+            shared_targets: Whether all members are trained on the same targets,
+                of shape `(batch_size, ...)`. If `False`, targets have shape
+                `(n_members, batch_size, ...)`, with separate targets per member.
+
+        The returned function maps ensemble outputs, of shape
+        `(n_members, batch_size, out_dim)`, and targets, to the sum of the member
+        losses. Since members don't share weights, the gradients for each member
+        are the same as when training it alone with `loss_fn`.
+        """
+
+        def _ensemble_loss(yhat: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+            if shared_targets:
+                return torch.stack([loss_fn(_yhat, y) for _yhat in yhat]).sum()
+            if len(y) != len(yhat):
+                raise ValueError(
+                    f"per member targets have {len(y)} members, expected {len(yhat)}"
+                )
+            return torch.stack([loss_fn(_yhat, _y) for _yhat, _y in zip(yhat, y)]).sum()
+
+        return _ensemble_loss
+
+
+_PathType = Union[str, "os.PathLike[str]"]
+_DataSource = Union[
+    Dataset,
+    Tuple[torch.Tensor, ...],
+    Tuple["np.ndarray", ...],
+    Tuple[_PathType, ...],
+    Sequence[Tuple[_PathType, ...]],
+]
+
+
+class _NpyDataset(Dataset):
+    # Dataset over a tuple of numpy arrays, which are typically memory-mapped. Only
+    # the requested samples are read, and copied into tensors.
+    def __init__(self, arrays: Sequence["np.ndarray"]):
+        if any(len(_a) != len(arrays[0]) for _a in arrays):
+            raise ValueError("size mismatch between dataset arrays")
+        self.arrays = arrays
+
+    def __len__(self) -> int:
+        return len(self.arrays[0])
+
+    def __getitem__(self, idx):
+        import numpy as np
+
+        return tuple(torch.from_numpy(np.array(_a[idx])) for _a in self.arrays)
+
+
+class _NpyShardsDataset(IterableDataset):  # pylint: disable=abstract-method
+    # Streaming dataset over shards, each of which is a tuple of `.npy` files with
+    # the same number of rows. Shards are split across data loader workers, and
+    # (if `split_processes` is `True`) distributed processes, and are memory-mapped
+    # one at a time. With `shuffle`, the order of shards, and of samples within each
+    # shard, is shuffled using `seed`, which should be updated for each epoch.
+    def __init__(
+        self,
+        shards: Sequence[Tuple[_PathType, ...]],
+        shuffle: bool,
+        split_processes: bool = True,
+    ):
+        self.shards = [tuple(os.fspath(_p) for _p in _shard) for _shard in shards]
+        self.shuffle = shuffle
+        self.split_processes = split_processes
+        self.seed = 0
+
+    def __iter__(self):
+        import numpy as np
+
+        if self.split_processes and dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        else:
+            rank, world_size = 0, 1
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            worker_id, n_workers = worker_info.id, worker_info.num_workers
+        else:
+            worker_id, n_workers = 0, 1
+        n_parts = world_size * n_workers
+        if len(self.shards) < n_parts:
+            raise ValueError(
+                f"need at least {n_parts} shards to split across "
+                f"{world_size} processes with {n_workers} workers each"
+            )
+
+        gen = torch.Generator()
+        gen.manual_seed(self.seed)
+        shard_order: Sequence[int] = range(len(self.shards))
+        if self.shuffle:
+            shard_order = torch.randperm(len(self.shards), generator=gen).tolist()
+
+        for _shard_idx in shard_order[rank * n_workers + worker_id :: n_parts]:
+            arrays = [np.load(_p, mmap_mode="r") for _p in self.shards[_shard_idx]]
+            if any(len(_a) != len(arrays[0]) for _a in arrays):
+                raise ValueError(
+                    f"size mismatch between arrays in shard {self.shards[_shard_idx]}"
+                )
+            sample_order: Iterable[int] = range(len(arrays[0]))
+            if self.shuffle:
+                sample_order = torch.randperm(len(arrays[0]), generator=gen).tolist()
+            for _i in sample_order:
+                yield tuple(torch.from_numpy(np.array(_a[_i])) for _a in arrays)
+
+
+class _TensorBatchLoader:
+    # Iterable over batches of a tuple of tensors held on `DEFAULT_DEVICE`. Batches
+    # are created by slicing the tensors (or with `index_select` when shuffling), so
+    # there is no per-sample indexing or collation like with `DataLoader`. With
+    # `world_size > 1`, only every `world_size`th sample (starting at `rank`) of the
+    # (shuffled) data is used.
+    def __init__(
+        self,
+        tensors: Sequence[torch.Tensor],
+        batch_size: int,
+        shuffle: bool,
+        drop_last: bool,
+        generator: Optional[torch.Generator] = None,
+        rank: int = 0,
+        world_size: int = 1,
+    ):
+        if any(len(_t) != len(tensors[0]) for _t in tensors):
+            raise ValueError("size mismatch between dataset tensors")
+        self.tensors = tuple(_t.to(_default_device()) for _t in tensors)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self.rank = rank
+        self.world_size = world_size
+
+    def __len__(self) -> int:
+        n = len(range(self.rank, len(self.tensors[0]), self.world_size))
+        if self.drop_last:
+            return n // self.batch_size
+        return math.ceil(n / self.batch_size)
+
+    def __iter__(self):
+        n = len(self.tensors[0])
+        idx = None
+        if self.shuffle:
+            idx = torch.randperm(n, generator=self.generator)
+        elif self.world_size > 1:
+            idx = torch.arange(n)
+        if idx is not None:
+            idx = idx[self.rank :: self.world_size].to(_default_device())
+
+        for _i in range(len(self)):
+            _s = slice(_i * self.batch_size, (_i + 1) * self.batch_size)
+            if idx is not None:
+                yield tuple(_t.index_select(0, idx[_s]) for _t in self.tensors)
+            else:
+                yield tuple(_t[_s] for _t in self.tensors)
+
+
+class _BatchPrefetcher:
+    # Iterator that pulls batches from `batches` in a background thread, and copies
+    # them to `DEFAULT_DEVICE` with non-blocking transfers, keeping up to `depth`
+    # batches ready. Exceptions raised while fetching are re-raised by `__next__`.
+    def __init__(self, batches: Iterator[Tuple[torch.Tensor, ...]], depth: int):
+        self._batches = batches
+        self._queue: "queue.Queue[Tuple[Any, Optional[BaseException]]]" = queue.Queue(
+            maxsize=depth
+        )
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fetch, daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        # Wait for space in the queue, unless the prefetcher is closed.
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fetch(self):
+        try:
+            for bat in self._batches:
+                bat = tuple(_t.to(_default_device(), non_blocking=True) for _t in bat)
+                if not self._put((bat, None)):
+                    return
+        except Exception as e:  # pylint: disable=broad-except
+            self._put((None, e))
+            return
+        self._put((None, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Tuple[torch.Tensor, ...]:
+        bat, exc = self._queue.get()
+        if exc is not None:
+            raise exc
+        if bat is None:
+            raise StopIteration
+        return bat
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def _to_cpu(obj: Any) -> Any:
+    # Copy all tensors in a nested structure of dicts/lists/tuples to CPU memory.
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {_k: _to_cpu(_v) for _k, _v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(_v) for _v in obj)
+    return obj
+
+
+class _CheckpointSaver:
+    # Saves checkpoints to `path` in a background thread. `save` copies the state to
+    # CPU memory on the calling thread, so training can continue modifying tensors,
+    # and the copy is then written to a temporary file, which is renamed to `path`.
+    # Only one save runs at a time: `save` first waits for the previous one.
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future: Optional[Future] = None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def _write(self, state: Dict[str, Any]):
+        tmp_path = f"{self.path}.tmp"
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def save(self, state: Dict[str, Any]):
+        self.wait()
+        self._future = self._executor.submit(self._write, _to_cpu(state))
+
+    def wait(self):
+        if self._future is not None:
+            future, self._future = self._future, None
+            future.result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown()
+
+
+class _EarlyStopper:
+    # Tracks a validation metric, and signals to stop training when the metric has
+    # not improved for `patience` consecutive updates. The state is saved in
+    # checkpoints with `state_dict`, and restored with `load_state_dict`.
+    def __init__(self, metric: str, mode: Literal["min", "max"], patience: int):
+        self.metric = metric
+        self.mode = mode
+        self.patience = patience
+        self._best: Optional[float] = None
+        self._n_bad = 0
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {"metric": self.metric, "best": self._best, "n_bad": self._n_bad}
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        if state["metric"] != self.metric:
+            logging.warning(
+                "early stopping metric changed from `%s` to `%s`: "
+                "not restoring early stopping state",
+                state["metric"],
+                self.metric,
+            )
+            return
+        self._best, self._n_bad = state["best"], state["n_bad"]
+
+    def update(self, val_results: Dict[str, float]) -> bool:
+        try:
+            val = val_results[self.metric]
+        except KeyError:
+            raise ValueError(
+                f"unknown early stopping metric: `{self.metric}`"
+            ) from None
+        if (
+            self._best is None
+            or (self.mode == "min" and val < self._best)
+            or (self.mode == "max" and val > self._best)
+        ):
+            self._best, self._n_bad = val, 0
+        else:
+            self._n_bad += 1
+        return self._n_bad >= self.patience
+
+
+class LazyMetrics:
+    """Running means of scalar metrics, accumulated without syncing with the host.
+
+    Values passed to `add` are summed on `DEFAULT_DEVICE`. Reading the means with
+    `read` needs a single device to host transfer for all metrics.
+
+    Usage::
+
+        >>> metrics = LazyMetrics()
+        >>> metrics.add("loss", loss)  # `loss` is a scalar tensor
+        >>> metrics.add("acc", acc)
+        >>> metrics.read()  # returns means since the last read
+        {'loss': 0.25, 'acc': 0.9}
+    """
+
+    def __init__(self):
+        self._sums: Dict[str, torch.Tensor] = {}
+        self._counts: Dict[str, float] = {}
+
+    def add(self, name: str, value: Union[torch.Tensor, float], weight: float = 1):
+        """Add a scalar value to the running mean of a metric.
+
+        Args:
+            name: Name of the metric.
+            value: Scalar tensor or float. Tensors are detached from the graph.
+            weight: Weight of the value in the mean (default: 1).
+        """
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+        value = torch.as_tensor(value, dtype=torch.float, device=_default_device())
+        if weight != 1:
+            value = value * weight
+        if name in self._sums:
+            self._sums[name] = self._sums[name] + value
+            self._counts[name] += weight
+        else:
+            self._sums[name] = value
+            self._counts[name] = weight
+
+    def read(self, reset: bool = True) -> Dict[str, float]:
+        """Get the mean of each metric.
+
+        Args:
+            reset: Whether to reset the running means after reading (default: `True`).
+        """
+        if not self._sums:
+            return {}
+        names = list(self._sums)
+        means = torch.stack([self._sums[_n] / self._counts[_n] for _n in names])
+        means_dict = dict(zip(names, means.tolist()))
+        if reset:
+            self._sums.clear()
+            self._counts.clear()
+        return means_dict
+
+
+class _PhaseTimer:
+    # Accumulates wall time spent in named phases of training. With CUDA, the device
+    # is synced at phase boundaries, so that asynchronous work is attributed to the
+    # phase which launched it. If not enabled, `phase` returns a no-op context.
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.totals: Dict[str, float] = {}
+
+    def phase(self, name: str) -> ContextManager:
+        if not self.enabled:
+            return nullcontext()
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name: str) -> Iterator[None]:
+        if _default_device().type == "cuda":
+            torch.cuda.synchronize()
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if _default_device().type == "cuda":
+                torch.cuda.synchronize()
+            self.totals[name] = (
+                self.totals.get(name, 0.0) + time.perf_counter() - t_start
+            )
+
+
+def _peak_memory() -> Optional[int]:
+    # Peak memory in bytes: allocated CUDA memory if training on CUDA, else the
+    # maximum resident set size of the process (if it can be read).
+    if _default_device().type == "cuda":
+        return torch.cuda.max_memory_allocated(_default_device())
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # `ru_maxrss` is in bytes on macOS, and in kilobytes elsewhere.
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class TrainSummary(NamedTuple):
+    """Summary of a training run, returned by `NNTrainer.train`.
+
+    Attributes:
+        iters: Number of iterations run (including any resumed from a checkpoint).
+        n_samples: Number of training samples processed in this run, across all
+            data parallel processes.
+        total_time: Wall time for the training loop, in seconds.
+        samples_per_sec: Training throughput (`n_samples / total_time`).
+        phase_times: Total wall time, in seconds, spent in each phase of training
+            (empty unless `NNTrainer.profile_phases` is `True`). Phases are `data`
+            (waiting for batches), `h2d` (host to device copy), `forward`, `loss`,
+            `backward`, `step` (optimizer step), `hook` (`post_iter_hook`),
+            `validation`, `checkpoint`, and `compile` (see `NNTrainer.compile`).
+        peak_memory: Peak CUDA memory allocated if training on CUDA, else the peak
+            resident memory of the process, in bytes (`None` if unavailable).
+    """
+
+    iters: int
+    n_samples: int
+    total_time: float
+    samples_per_sec: float
+    phase_times: Dict[str, float]
+    peak_memory: Optional[int]
+
 
 class NNTrainer(Corgy):
     """Helper class for training a PyTorch model on a dataset."""
 
-    __slots__ = ("_dataset", "_data_loader")
+    __slots__ = (
+        "_dataset",
+        "_data_loader",
+        "_data_gen",
+        "_metrics",
+        "_val_data_loader",
+        "_val_results",
+    )
 
     iters: Annotated[int, "number of training iterations"]
     ptopt: Annotated[PTOpt, "optimizer and learning rate scheduler"]
     batch_size: Annotated[int, "batch size for training"] = 8
     data_workers: Annotated[int, "number of workers for loading data"] = 0
     shuffle_data: Annotated[bool, "whether to shuffle the dataset"] = True
-    pin_cuda: Annotated[bool, "whether to pin data to CUDA memory"] = True
+    pin_cuda: Annotated[
+        bool, "whether to pin data to CUDA memory (ignored if CUDA is not available)"
+    ] = True
     drop_last: Annotated[bool, "whether to drop the last incomplete batch"] = False
     pbar_desc: Annotated[str, "description for training progress bar"] = "Training"
+    device_data: Annotated[
+        bool,
+        "whether to keep tensor datasets on the training device, and create batches "
+        "by slicing instead of with a data loader",
+    ] = False
+    prefetch_batches: Annotated[
+        int,
+        "number of batches to load, and copy to the training device, in a "
+        "background thread ahead of use (0 to disable)",
+    ] = 0
+    report_every: Annotated[
+        int, "number of iterations between updates of the progress bar metrics"
+    ] = 10
+    precision: Annotated[
+        Literal["fp32", "bf16", "fp16"],
+        "precision for the forward pass and loss: 'bf16' and 'fp16' use autocast, "
+        "and 'fp16' also uses gradient scaling (needs CUDA)",
+    ] = "fp32"
+    grad_accum_batches: Annotated[
+        int, "number of batches to accumulate gradients over for each optimizer step"
+    ] = 1
+    micro_batch_size: Annotated[
+        Optional[int],
+        "size of micro-batches to split each batch into, accumulating gradients "
+        "(default: no splitting)",
+    ] = None
+    ckpt_path: Annotated[
+        Optional[str], "file to save training checkpoints to (default: no saving)"
+    ] = None
+    ckpt_every: Annotated[int, "number of iterations between checkpoints"] = 1000
+    ckpt_resume: Annotated[
+        bool, "whether to resume training from `ckpt_path` if it exists"
+    ] = True
+    dp_workers: Annotated[
+        int, "number of processes for data parallel training on CPU (1 to disable)"
+    ] = 1
+    val_every: Annotated[int, "number of iterations between validations"] = 1000
+    val_batch_size: Annotated[int, "batch size for validation"] = 256
+    early_stop_patience: Annotated[
+        Optional[int],
+        "number of validations without improvement after which to stop training "
+        "(default: no early stopping)",
+    ] = None
+    early_stop_metric: Annotated[
+        str, "validation metric monitored for early stopping"
+    ] = "loss"
+    early_stop_mode: Annotated[
+        Literal["min", "max"], "whether the monitored metric should be minimized"
+    ] = "min"
+    profile_phases: Annotated[
+        bool,
+        "whether to record the time spent in each phase of training (syncs the "
+        "device at phase boundaries)",
+    ] = False
+    compile: Annotated[
+        Literal["off", "torch", "jit"],
+        "how to compile the model for training: 'torch' uses `torch.compile`, and "
+        "'jit' uses TorchScript (scripting, or tracing if that fails)",
+    ] = "off"
+    compile_loss: Annotated[
+        bool, "whether to also compile the loss function (if `compile` is not 'off')"
+    ] = False
 
-    def set_dataset(
-        self, value: Union[Dataset, Tuple[torch.Tensor, ...], Tuple["np.ndarray", ...]]
-    ):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._metrics = LazyMetrics()
+        self._val_data_loader = None
+        self._val_results: Dict[str, float] = {}
+
+    @property
+    def metrics(self) -> LazyMetrics:
+        """`LazyMetrics` instance with metrics shown in the progress bar.
+
+        The training loss is added to this after each iteration. `post_iter_hook` can
+        add other metrics with `metrics.add`, which avoids syncing with the device.
+        """
+        return self._metrics
+
+    @property
+    def val_results(self) -> Dict[str, float]:
+        """Metrics from the latest validation."""
+        return self._val_results
+
+    @staticmethod
+    def _to_dataset(value: _DataSource, shuffle: bool = False) -> Dataset:
+        if isinstance(value, Dataset):
+            return value
+        if not isinstance(value, (list, tuple)):
+            raise ValueError(f"can't set dataset from type `{type(value)}`")
+        if not value:
+            raise ValueError(f"can't set dataset from empty `{type(value)}`")
+        if all(isinstance(_v, tuple) for _v in value):
+            shards = cast(Sequence[Tuple[_PathType, ...]], value)
+            return _NpyShardsDataset(shards, shuffle)
+        if isinstance(value, list):
+            raise TypeError(
+                f"dataset shards must be tuples of paths, not `{type(value[0])}`"
+            )
+        if isinstance(value[0], torch.Tensor):
+            return TensorDataset(*value)
+
+        import numpy as np
+
+        if isinstance(value[0], (str, os.PathLike)):
+            paths = cast(Tuple[_PathType, ...], value)
+            return _NpyDataset([np.load(_p, mmap_mode="r") for _p in paths])
+        arrays = cast(Tuple[np.ndarray, ...], value)
+        if isinstance(arrays[0], np.memmap):
+            return _NpyDataset(arrays)
+        return TensorDataset(*(torch.from_numpy(val_i) for val_i in arrays))
+
+    def set_dataset(self, value: _DataSource):
         """Set the training data.
 
         Args:
-            value: `torch.utils.data.Dataset` instance, or tuple of `torch.Tensor` or
-                `np.ndarray` objects.
+            value: `torch.utils.data.Dataset` instance, tuple of `torch.Tensor` or
+                `np.ndarray` objects, tuple of paths to `.npy` files, or list (or
+                tuple) of tuples of paths (shards).
+
+        `.npy` files, and `np.memmap` arrays, are read lazily from disk, without
+        loading them into memory. A sequence of shards is read as a stream: each shard
+        is a tuple of `.npy` files with the same number of rows, and shards are split
+        across `data_workers` (and data parallel processes), so there should be at
+        least as many shards as workers. With `shuffle_data`, the order of shards and
+        of samples within each shard is shuffled.
+
+        If `device_data` is `True`, `value` must be a tuple of tensors or in-memory
+        arrays, or a `TensorDataset`. The tensors are moved to `DEFAULT_DEVICE` once,
+        and batches are created by slicing them directly, which is much faster than a
+        `DataLoader` for small models.
         """
-        if isinstance(value, Dataset):
-            self._dataset = value
-        elif isinstance(value, tuple):
-            if not isinstance(value[0], torch.Tensor):
-                value = tuple(torch.from_numpy(val_i) for val_i in value)
-            self._dataset = TensorDataset(*value)
+        self._dataset = self._to_dataset(value, self.shuffle_data)
+        if self.device_data and not isinstance(self._dataset, TensorDataset):
+            raise ValueError(
+                "`device_data` needs a tuple of tensors/in-memory arrays, or a "
+                f"`TensorDataset`, not `{type(value)}`"
+            )
+
+        # Shuffling uses a separate generator, which is re-seeded for each epoch,
+        # so that the data position can be restored from a checkpoint.
+        self._data_gen = torch.Generator()
+        self._data_loader = self._make_data_loader()
+
+    def set_val_dataset(self, value: _DataSource):
+        """Set the validation data.
+
+        Args:
+            value: Validation data, in any of the forms accepted by `set_dataset`.
+
+        The validation data loader is created once, and reused for each validation.
+        Batches have size `val_batch_size`. If `device_data` is `True`, and `value` is
+        a tuple or `TensorDataset`, the tensors are kept on `DEFAULT_DEVICE`.
+        """
+        val_dataset = self._to_dataset(value)
+        if isinstance(val_dataset, _NpyShardsDataset):
+            # Validation is done by a single process, over all the data.
+            val_dataset.split_processes = False
+        if self.device_data and isinstance(val_dataset, TensorDataset):
+            self._val_data_loader = _TensorBatchLoader(
+                val_dataset.tensors,
+                batch_size=self.val_batch_size,
+                shuffle=False,
+                drop_last=False,
+            )
         else:
-            raise ValueError(f"can't set dataset from type `{type(value)}`")
+            self._val_data_loader = DataLoader(
+                val_dataset,
+                batch_size=self.val_batch_size,
+                num_workers=self.data_workers,
+                persistent_workers=self.data_workers > 0,
+                pin_memory=self.pin_cuda and _default_device().type == "cuda",
+            )
+
+    def _make_data_loader(
+        self, rank: int = 0, world_size: int = 1, data_seed: int = 0
+    ) -> Iterable[Tuple[torch.Tensor, ...]]:
+        # Create a data loader for the dataset. With `world_size > 1`, the loader
+        # only loads the data shard for `rank`, with shuffling seeded by `data_seed`.
+        if self.device_data:
+            return _TensorBatchLoader(
+                cast(TensorDataset, self._dataset).tensors,
+                batch_size=self.batch_size,
+                shuffle=self.shuffle_data,
+                drop_last=self.drop_last,
+                generator=self._data_gen,
+                rank=rank,
+                world_size=world_size,
+            )
 
-        self._data_loader = DataLoader(
+        sampler: Optional[Sampler] = None
+        if isinstance(self._dataset, IterableDataset):
+            # Iterable datasets shuffle, and split across processes, by themselves.
+            return DataLoader(
+                self._dataset,
+                batch_size=self.batch_size,
+                num_workers=self.data_workers,
+                pin_memory=self.pin_cuda and _default_device().type == "cuda",
+                drop_last=self.drop_last,
+                generator=self._data_gen,
+            )
+        if world_size > 1:
+            sampler = DistributedSampler(
+                self._dataset,
+                num_replicas=world_size,
+                rank=rank,
+                shuffle=self.shuffle_data,
+                seed=data_seed,
+                drop_last=self.drop_last,
+            )
+        return DataLoader(
             self._dataset,
             batch_size=self.batch_size,
             num_workers=self.data_workers,
-            shuffle=self.shuffle_data,
-            pin_memory=self.pin_cuda,
+            shuffle=self.shuffle_data if sampler is None else False,
+            sampler=sampler,
+            pin_memory=self.pin_cuda and _default_device().type == "cuda",
             drop_last=self.drop_last,
+            generator=self._data_gen,
+        )
+
+    def _iter_batches(
+        self,
+        data_loader: Iterable[Tuple[torch.Tensor, ...]],
+        n: int,
+        data_seed: int,
+        start: int = 0,
+    ) -> Iterator[Tuple[torch.Tensor, ...]]:
+        # Yield `n` batches from `data_loader`, restarting it as needed, and
+        # skipping the first `start` batches. The data generator is seeded with
+        # `data_seed + epoch` at the start of each epoch.
+        def _epoch_iter(_epoch):
+            self._data_gen.manual_seed(data_seed + _epoch)
+            if isinstance(getattr(data_loader, "sampler", None), DistributedSampler):
+                data_loader.sampler.set_epoch(_epoch)  # type: ignore
+            if isinstance(getattr(data_loader, "dataset", None), _NpyShardsDataset):
+                data_loader.dataset.seed = data_seed + _epoch  # type: ignore
+            return iter(data_loader)
+
+        epoch, epoch_start = 0, 0
+        if start > 0:
+            try:
+                epoch, epoch_start = divmod(start, len(data_loader))  # type: ignore
+            except TypeError:
+                logging.warning(
+                    "data loader has no length: restarting data from first epoch"
+                )
+
+        bat_iter = islice(_epoch_iter(epoch), epoch_start, None)
+        for _ in range(n):
+            try:
+                bat = next(bat_iter)
+            except StopIteration:
+                epoch += 1
+                bat_iter = _epoch_iter(epoch)
+                try:
+                    bat = next(bat_iter)
+                except StopIteration:
+                    raise ValueError("data loader yields no batches") from None
+            yield bat
+
+    @staticmethod
+    def _get_rng_state() -> Dict[str, Any]:
+        state = {"torch": torch.get_rng_state(), "random": random.getstate()}
+        if torch.cuda.is_available():
+            state["cuda"] = torch.cuda.get_rng_state_all()
+        return state
+
+    @staticmethod
+    def _set_rng_state(state: Dict[str, Any]):
+        torch.set_rng_state(state["torch"])
+        random.setstate(state["random"])
+        if "cuda" in state:
+            torch.cuda.set_rng_state_all(state["cuda"])
+
+    def _split_micro_batches(
+        self, bats: Sequence[Tuple[torch.Tensor, ...]]
+    ) -> Sequence[Tuple[torch.Tensor, ...]]:
+        # Split each batch into micro-batches of size `micro_batch_size` (if set).
+        if self.micro_batch_size is None:
+            return bats
+        return [
+            _mbat
+            for _bat in bats
+            for _mbat in zip(*(_t.split(self.micro_batch_size) for _t in _bat))
+        ]
+
+    def _accumulate_grads(
+        self,
+        model: nn.Module,
+        loss_fn: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+        bats: Sequence[Tuple[torch.Tensor, ...]],
+        autocast_dtype: torch.dtype,
+        grad_scaler: Optional[GradScaler],
+        timer: _PhaseTimer,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        # Run forward and backward passes for the micro-batches in `bats`, with each
+        # loss weighted by the size of its micro-batch, so that the accumulated
+        # gradients match a single pass over the whole logical batch. Returns the
+        # logical batch inputs, targets, outputs, and loss. For distributed models,
+        # gradients are only synced in the backward pass of the last micro-batch.
+        n_bat = sum(len(_bat[0]) for _bat in bats)
+        x_bats, y_bats, yhat_bats, losses = [], [], [], []
+        for _i, (x_bat, y_bat) in enumerate(bats):
+            with timer.phase("h2d"):
+                x_bat = x_bat.to(_default_device(), non_blocking=True)
+                y_bat = y_bat.to(_default_device(), non_blocking=True)
+
+            if isinstance(model, DistributedDataParallel) and _i < len(bats) - 1:
+                # The type stub for `DistributedDataParallel` doesn't have `no_sync`.
+                grad_sync_ctx: ContextManager = model.no_sync()  # type: ignore
+            else:
+                grad_sync_ctx = nullcontext()
+
+            with grad_sync_ctx:
+                with self._autocast(autocast_dtype):
+                    with timer.phase("forward"):
+                        yhat_bat = model(x_bat)
+                    with timer.phase("loss"):
+                        loss = loss_fn(yhat_bat, y_bat)
+                if len(bats) > 1:
+                    loss = loss * (len(x_bat) / n_bat)
+
+                with timer.phase("backward"):
+                    if grad_scaler is not None:
+                        grad_scaler.scale(loss).backward()
+                    else:
+                        loss.backward()
+
+            if len(bats) == 1:
+                return x_bat, y_bat, yhat_bat, loss
+            x_bats.append(x_bat)
+            y_bats.append(y_bat)
+            yhat_bats.append(yhat_bat.detach())
+            losses.append(loss.detach())
+
+        return (
+            torch.cat(x_bats),
+            torch.cat(y_bats),
+            torch.cat(yhat_bats),
+            torch.stack(losses).sum(),
         )
 
+    def _autocast(self, autocast_dtype: torch.dtype) -> ContextManager:
+        # `torch.autocast` for the forward pass and loss, or a no-op with "fp32"
+        # precision.
+        if self.precision == "fp32":
+            return nullcontext()
+        return torch.autocast(_default_device().type, dtype=autocast_dtype)
+
+    def _compile_fn(
+        self,
+        fn: Callable[..., torch.Tensor],
+        example_args: Tuple[torch.Tensor, ...],
+        autocast_dtype: torch.dtype,
+    ) -> Callable[..., torch.Tensor]:
+        # Compile `fn` (a module or function) with the method set by `compile`, and
+        # check that it matches `fn` on `example_args`. If compilation fails, or the
+        # results don't match, a warning is shown, and `fn` is returned.
+        fn_name = type(fn).__name__ if isinstance(fn, nn.Module) else fn.__name__
+        try:
+            if self.compile == "torch":
+                if not hasattr(torch, "compile"):
+                    raise RuntimeError("`torch.compile` needs PyTorch 2.0 or later")
+                compiled_fn = torch.compile(fn)
+            else:
+                try:
+                    compiled_fn = torch.jit.script(fn)
+                except Exception:  # pylint: disable=broad-except
+                    compiled_fn = torch.jit.trace(fn, example_args, check_trace=False)
+
+            # Run both versions from the same random state, and restore module
+            # buffers (like batch norm statistics) afterwards, so that the check
+            # has no side effects.
+            rng_state = self._get_rng_state()
+            buffers = {}
+            if isinstance(fn, nn.Module):
+                buffers = {_k: _v.clone() for _k, _v in fn.named_buffers()}
+            with torch.no_grad(), self._autocast(autocast_dtype):
+                expected = fn(*example_args)
+                self._set_rng_state(rng_state)
+                actual = compiled_fn(*example_args)
+            self._set_rng_state(rng_state)
+            if isinstance(fn, nn.Module):
+                fn.load_state_dict(buffers, strict=False)
+            if not match_tensors(actual.float(), expected.float(), do_fail=False):
+                raise RuntimeError("compiled results do not match eager mode")
+        except Exception as e:  # pylint: disable=broad-except
+            warnings.warn(
+                f"could not compile `{fn_name}`, using eager mode: {e}", RuntimeWarning
+            )
+            return fn
+        logging.info("compiled `%s` with `%s`", fn_name, self.compile)
+        return compiled_fn
+
+    def _compile(
+        self,
+        model: nn.Module,
+        loss_fn: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+        bat: Tuple[torch.Tensor, ...],
+        autocast_dtype: torch.dtype,
+    ) -> Tuple[nn.Module, Callable[[torch.Tensor, torch.Tensor], torch.Tensor]]:
+        # Compile the model, and if `compile_loss` is set, the loss function, using
+        # `bat` as example input. The compiled model shares parameters with `model`.
+        x_bat, y_bat = (_t.to(_default_device()) for _t in bat)
+        compiled_model = self._compile_fn(model, (x_bat,), autocast_dtype)
+        if not self.compile_loss:
+            return compiled_model, loss_fn  # type: ignore
+        with torch.no_grad(), self._autocast(autocast_dtype):
+            yhat_bat = model(x_bat)
+        compiled_loss_fn = self._compile_fn(loss_fn, (yhat_bat, y_bat), autocast_dtype)
+        return compiled_model, compiled_loss_fn  # type: ignore
+
+    def _validate(
+        self,
+        model: nn.Module,
+        loss_fn: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+        val_metric_fns: Dict[str, Callable[[torch.Tensor, torch.Tensor], torch.Tensor]],
+        autocast_dtype: torch.dtype,
+    ) -> Dict[str, float]:
+        # Compute the mean loss, and other metrics, over the validation data.
+        was_training = model.training
+        model.eval()
+        val_metrics = LazyMetrics()
+        with torch.inference_mode(), self._autocast(autocast_dtype):
+            for x_bat, y_bat in self._val_data_loader:
+                x_bat = x_bat.to(_default_device(), non_blocking=True)
+                y_bat = y_bat.to(_default_device(), non_blocking=True)
+                yhat_bat = model(x_bat)
+                val_metrics.add("loss", loss_fn(yhat_bat, y_bat), len(x_bat))
+                for _name, _fn in val_metric_fns.items():
+                    val_metrics.add(_name, _fn(yhat_bat, y_bat), len(x_bat))
+            results = val_metrics.read()
+        model.train(was_training)
+        return results
+
     def train(
         self,
         model: nn.Module,
@@ -349,7 +2258,11 @@ class NNTrainer(Corgy):
                 [int, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, Any], None
             ]
         ] = None,
-    ):
+        val_metric_fns: Optional[
+            Dict[str, Callable[[torch.Tensor, torch.Tensor], torch.Tensor]]
+        ] = None,
+        tb_logs: Optional["TBLogs"] = None,
+    ) -> TrainSummary:
         """Train a model.
 
         Args:
@@ -358,33 +2271,851 @@ class NNTrainer(Corgy):
             post_iter_hook: Optional callback function to call after each iteration.
                 The function will be called with arguments
                 `(iteration, x_batch, y_batch, yhat_batch, loss, pbar)`.
+            val_metric_fns: Optional dictionary of metric functions to compute on the
+                validation data, in addition to the loss. Each function maps output and
+                target tensors to a scalar tensor, which is averaged over samples.
+            tb_logs: Optional `TBLogs` instance to write the training summary to.
+
+        Returns:
+            `TrainSummary` with the throughput, peak memory, and (if `profile_phases`
+            is `True`) time spent in each phase of training.
+
+        If `prefetch_batches` is positive, batches are loaded in a background thread,
+        and copied to `DEFAULT_DEVICE` without blocking, so that data loading overlaps
+        with training.
+
+        The mean training loss, and any metrics added to `metrics` by
+        `post_iter_hook`, are shown in the progress bar every `report_every`
+        iterations. The device is only synced with the host at these updates.
+
+        If `precision` is not `fp32`, the model and loss function are run under
+        `torch.autocast` with the corresponding data type.
+
+        Each iteration is one optimizer step on a logical batch made of
+        `grad_accum_batches` batches, optionally split into micro-batches of size
+        `micro_batch_size`. Gradients are accumulated over the micro-batches, with
+        each loss weighted by the micro-batch size, which assumes that `loss_fn`
+        averages over samples. If a logical batch has more than one micro-batch,
+        `post_iter_hook` gets the concatenated batches and outputs (detached from the
+        graph), and the weighted mean loss.
+
+        If `ckpt_path` is set, a checkpoint is saved every `ckpt_every` iterations,
+        and at the end of training. Checkpoints store the model, optimizer, and lr
+        scheduler states, along with the iteration, random number generator states,
+        data position, and early stopping state. They are written in a background
+        thread, and atomically replace the previous checkpoint. If `ckpt_resume` is
+        `True`, and `ckpt_path` exists, training is resumed from the saved
+        checkpoint, unless the checkpoint was saved after stopping early.
+
+        If `dp_workers` is more than 1, training is done on CPU by that many forked
+        processes, which communicate with the `gloo` backend. Each process trains on
+        a separate shard of the dataset, with `batch_size` samples per batch, and
+        gradients are averaged across processes before each optimizer step. Only the
+        first process shows progress, logs, saves checkpoints, and calls
+        `post_iter_hook`. When training finishes, `model` is updated with the trained
+        weights, and `ptopt` with the optimizer and scheduler state of the first
+        process, as with a single process.
+
+        If a validation dataset is set with `set_val_dataset`, the model is evaluated
+        every `val_every` iterations, and at the end of training, under
+        `torch.inference_mode`. Results are logged, shown in the progress bar, and
+        available in `val_results`. If `early_stop_patience` is set, training is
+        stopped when `early_stop_metric` has not improved for that many validations.
+
+        If `profile_phases` is `True`, the wall time of each phase of training
+        (waiting for data, host to device copy, forward, loss, backward, optimizer
+        step, hook, validation, and checkpointing) is recorded, and logged at the end
+        of training. With CUDA, this syncs the device at each phase boundary, which
+        slows down training. If `tb_logs` is given, the summary is written to it as
+        scalars under `train/`, at step `iters`.
+
+        If `compile` is not `off`, the model (and with `compile_loss`, the loss
+        function) is compiled before training, with `torch.compile` or TorchScript.
+        The compiled version is checked against eager mode on the first batch, with
+        `match_tensors`, and if compilation fails, or the results don't match, a
+        warning is shown, and training uses eager mode. The compiled model shares
+        parameters with `model`, which is still used for validation and checkpoints.
         """
         if self._dataset is None:
             raise RuntimeError("dataset not set: call `set_dataset` before `train`")
-        bat_iter = iter(self._data_loader)
+        if self.precision == "fp16" and _default_device().type != "cuda":
+            raise ValueError("`fp16` precision needs CUDA: use `bf16` instead")
+        data_seed = int(torch.empty((), dtype=torch.int64).random_())
+
+        if val_metric_fns is None:
+            val_metric_fns = {}
 
-        model = model.to(DEFAULT_DEVICE)
+        if self.dp_workers <= 1:
+            summary = self._train(
+                model, loss_fn, post_iter_hook, val_metric_fns, data_seed
+            )
+            self._write_summary(summary, tb_logs)
+            return summary
+
+        if _default_device().type != "cpu":
+            raise ValueError("data parallel training is only supported on CPU")
+        # Workers are forked, so arguments don't need to be picklable. The trained
+        # weights are sent back through shared memory, and validation results, the
+        # training summary, and the state of `ptopt`, through a queue.
+        shared_state = {
+            _k: _v.detach().clone().share_memory_()
+            for _k, _v in model.state_dict().items()
+        }
+        results_queue = mp.get_context("fork").SimpleQueue()
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        mp.start_processes(
+            self._train_worker,
+            args=(
+                model,
+                loss_fn,
+                post_iter_hook,
+                val_metric_fns,
+                data_seed,
+                shared_state,
+                results_queue,
+                port,
+            ),
+            nprocs=self.dp_workers,
+            start_method="fork",
+        )
+        model.load_state_dict(shared_state)
+        self._val_results, summary, ptopt_state = results_queue.get()
         self.ptopt.set_weights(model.parameters())
+        self.ptopt.load_state_dict(torch.load(io.BytesIO(ptopt_state)))
+        self._write_summary(summary, tb_logs)
+        return summary
 
-        with trange(self.iters, desc=self.pbar_desc) as pbar:
-            for _iter in pbar:
-                try:
-                    x_bat, y_bat = next(bat_iter)
-                except StopIteration:
-                    bat_iter = iter(self._data_loader)
-                    x_bat, y_bat = next(bat_iter)
-                x_bat, y_bat = x_bat.to(DEFAULT_DEVICE), y_bat.to(DEFAULT_DEVICE)
+    def _train_worker(
+        self,
+        rank: int,
+        model: nn.Module,
+        loss_fn: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+        post_iter_hook: Optional[Callable[..., None]],
+        val_metric_fns: Dict[str, Callable[..., torch.Tensor]],
+        data_seed: int,
+        shared_state: Dict[str, torch.Tensor],
+        results_queue: Any,
+        port: int,
+    ):
+        # Entry point for data parallel training processes.
+        os.environ["MASTER_ADDR"] = "127.0.0.1"
+        os.environ["MASTER_PORT"] = str(port)
+        dist.init_process_group("gloo", rank=rank, world_size=self.dp_workers)
+        torch.set_num_threads(max(1, torch.get_num_threads() // self.dp_workers))
+        if rank != 0:
+            logging.root.setLevel(logging.WARNING)
+        try:
+            summary = self._train(
+                model, loss_fn, post_iter_hook, val_metric_fns, data_seed
+            )
+            if rank == 0:
+                for _k, _v in model.state_dict().items():
+                    shared_state[_k].copy_(_v)
+                # Tensors put in the queue would be shared through file
+                # descriptors, which are closed when this process exits, so the
+                # optimizer state is serialized.
+                ptopt_state = io.BytesIO()
+                torch.save(self.ptopt.state_dict(), ptopt_state)
+                results_queue.put((self._val_results, summary, ptopt_state.getvalue()))
+        finally:
+            dist.destroy_process_group()
+
+    def _train(
+        self,
+        model: nn.Module,
+        loss_fn: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+        post_iter_hook: Optional[Callable[..., None]],
+        val_metric_fns: Dict[str, Callable[..., torch.Tensor]],
+        data_seed: int,
+    ) -> TrainSummary:
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        else:
+            rank, world_size = 0, 1
+        autocast_dtype = torch.float16 if self.precision == "fp16" else torch.bfloat16
+        grad_scaler = GradScaler() if self.precision == "fp16" else None
 
-                yhat_bat = model(x_bat)
-                loss = loss_fn(yhat_bat, y_bat)
-                pbar.set_postfix(loss=float(loss))
+        model = model.to(_default_device())
+        self.ptopt.set_weights(model.parameters())
+        self._metrics.read()
+        timer = _PhaseTimer(self.profile_phases)
+        if _default_device().type == "cuda":
+            torch.cuda.reset_peak_memory_stats(_default_device())
+
+        early_stopper = None
+        if self.early_stop_patience is not None:
+            early_stopper = _EarlyStopper(
+                self.early_stop_metric, self.early_stop_mode, self.early_stop_patience
+            )
+
+        start_iter, end_iter = 0, self.iters
+        ckpt_saver = None
+        if self.ckpt_path is not None:
+            if self.ckpt_resume and os.path.exists(self.ckpt_path):
+                ckpt = torch.load(self.ckpt_path, map_location="cpu")
+                model.load_state_dict(ckpt["model"])
+                self.ptopt.load_state_dict(ckpt["ptopt"])
+                if grad_scaler is not None and "grad_scaler" in ckpt:
+                    grad_scaler.load_state_dict(ckpt["grad_scaler"])
+                self._set_rng_state(ckpt["rng"])
+                start_iter, data_seed = ckpt["iteration"], ckpt["data_seed"]
+                if early_stopper is not None and "early_stopper" in ckpt:
+                    early_stopper.load_state_dict(ckpt["early_stopper"])
+                if ckpt.get("stopped_early", False):
+                    # The run already ended, so it is not continued.
+                    end_iter = start_iter
+                    logging.info(
+                        "not resuming training: `%s` was saved after stopping early "
+                        "at iteration %d",
+                        self.ckpt_path,
+                        start_iter,
+                    )
+                else:
+                    logging.info(
+                        "resuming training from iteration %d of `%s`",
+                        start_iter,
+                        self.ckpt_path,
+                    )
+            if rank == 0:
+                ckpt_saver = _CheckpointSaver(self.ckpt_path)
+
+        def _save_ckpt(_n_iters, _stopped_early):
+            ckpt = {
+                "model": model.state_dict(),
+                "ptopt": self.ptopt.state_dict(),
+                "rng": self._get_rng_state(),
+                "iteration": _n_iters,
+                "data_seed": data_seed,
+                "stopped_early": _stopped_early,
+            }
+            if early_stopper is not None:
+                ckpt["early_stopper"] = early_stopper.state_dict()
+            if grad_scaler is not None:
+                ckpt["grad_scaler"] = grad_scaler.state_dict()
+            ckpt_saver.save(ckpt)
+
+        if world_size > 1:
+            data_loader = self._make_data_loader(rank, world_size, data_seed)
+        else:
+            data_loader = self._data_loader
+
+        bat_iter: Iterator[Tuple[torch.Tensor, ...]] = self._iter_batches(
+            data_loader,
+            (end_iter - start_iter) * self.grad_accum_batches,
+            data_seed,
+            start_iter * self.grad_accum_batches,
+        )
+        prefetcher = None
+        if self.prefetch_batches > 0:
+            bat_iter = prefetcher = _BatchPrefetcher(bat_iter, self.prefetch_batches)
+
+        self._val_results = {}
+        n_iters, n_samples = start_iter, 0
+        t_start = time.perf_counter()
+        with _trange(
+            start_iter,
+            end_iter,
+            desc=self.pbar_desc,
+            initial=start_iter,
+            total=self.iters,
+            disable=rank != 0,
+        ) as pbar:
+            try:
+                train_model: nn.Module = model
+                train_loss_fn = loss_fn
+                if self.compile != "off":
+                    # The first batch is used to check the compiled model, and put
+                    # back in front of the batch iterator.
+                    with timer.phase("compile"):
+                        first_bats = list(islice(bat_iter, 1))
+                        bat_iter = chain(first_bats, bat_iter)
+                        if first_bats:
+                            train_model, train_loss_fn = self._compile(
+                                model, loss_fn, first_bats[0], autocast_dtype
+                            )
+                if world_size > 1:
+                    train_model = DistributedDataParallel(train_model)
+
+                for _iter in pbar:
+                    with timer.phase("data"):
+                        bats = self._split_micro_batches(
+                            list(islice(bat_iter, self.grad_accum_batches))
+                        )
+
+                    with timer.phase("step"):
+                        self.ptopt.zero_grad()
+                    x_bat, y_bat, yhat_bat, loss = self._accumulate_grads(
+                        train_model,
+                        train_loss_fn,
+                        bats,
+                        autocast_dtype,
+                        grad_scaler,
+                        timer,
+                    )
+                    with timer.phase("step"):
+                        self.ptopt.step(grad_scaler)
+                    n_iters = _iter + 1
+                    n_samples += len(x_bat)
+                    self._metrics.add("loss", loss)
+
+                    if post_iter_hook is not None and rank == 0:
+                        with timer.phase("hook"):
+                            post_iter_hook(_iter, x_bat, y_bat, yhat_bat, loss, pbar)
+
+                    stop = False
+                    if self._val_data_loader is not None and (
+                        (_iter + 1) % self.val_every == 0 or _iter + 1 == self.iters
+                    ):
+                        if rank == 0:
+                            with timer.phase("validation"):
+                                self._val_results = self._validate(
+                                    model, loss_fn, val_metric_fns, autocast_dtype
+                                )
+                            logging.info(
+                                "%s: iteration %d: validation %s",
+                                self.pbar_desc,
+                                _iter + 1,
+                                self._val_results,
+                            )
+
+                        if early_stopper is not None:
+                            if rank == 0:
+                                stop = early_stopper.update(self._val_results)
+                            if world_size > 1:
+                                _stop = torch.tensor(int(stop))
+                                dist.broadcast(_stop, 0)
+                                stop = bool(_stop)
+
+                    if (
+                        (_iter + 1) % self.report_every == 0
+                        or _iter + 1 == self.iters
+                        or stop
+                    ):
+                        pbar.set_postfix(
+                            {
+                                **self._metrics.read(),
+                                **{
+                                    f"val_{_k}": _v
+                                    for _k, _v in self._val_results.items()
+                                },
+                            }
+                        )
+
+                    if ckpt_saver is not None and (
+                        (_iter + 1) % self.ckpt_every == 0
+                        or _iter + 1 == self.iters
+                        or stop
+                    ):
+                        with timer.phase("checkpoint"):
+                            _save_ckpt(_iter + 1, stop)
+
+                    if stop:
+                        logging.info(
+                            "%s: stopping early at iteration %d: no improvement in "
+                            "`%s` for %d validations",
+                            self.pbar_desc,
+                            _iter + 1,
+                            self.early_stop_metric,
+                            self.early_stop_patience,
+                        )
+                        break
+            finally:
+                if prefetcher is not None:
+                    prefetcher.close()
+                if ckpt_saver is not None:
+                    ckpt_saver.close()
+
+        if _default_device().type == "cuda":
+            torch.cuda.synchronize()
+        if world_size > 1:
+            _n_samples_all = torch.tensor(n_samples)
+            dist.all_reduce(_n_samples_all)
+            n_samples = int(_n_samples_all)
+        t_elapsed = time.perf_counter() - t_start
+        summary = TrainSummary(
+            iters=n_iters,
+            n_samples=n_samples,
+            total_time=t_elapsed,
+            samples_per_sec=n_samples / t_elapsed,
+            phase_times=timer.totals,
+            peak_memory=_peak_memory(),
+        )
+        logging.info(
+            "%s: %d samples in %.2fs (%.1f samples/sec, %s)",
+            self.pbar_desc,
+            n_samples,
+            t_elapsed,
+            summary.samples_per_sec,
+            "device data" if self.device_data else "data loader",
+        )
+        if summary.phase_times:
+            logging.info(
+                "%s: phase times: %s",
+                self.pbar_desc,
+                ", ".join(
+                    f"{_name} {_t:.2f}s ({100 * _t / t_elapsed:.1f}%)"
+                    for _name, _t in sorted(
+                        summary.phase_times.items(), key=lambda _kv: -_kv[1]
+                    )
+                ),
+            )
+        return summary
+
+    def _write_summary(self, summary: TrainSummary, tb_logs: Optional["TBLogs"]):
+        # Write the training summary as scalars to TensorBoard logs.
+        if tb_logs is None:
+            return
+        scalars: Dict[str, float] = {
+            "train/samples_per_sec": summary.samples_per_sec,
+            "train/total_time": summary.total_time,
+        }
+        if summary.peak_memory is not None:
+            scalars["train/peak_memory"] = summary.peak_memory
+        for _name, _t in summary.phase_times.items():
+            scalars[f"train/time/{_name}"] = _t
+        for _tag, _val in scalars.items():
+            tb_logs.writer.add_scalar(_tag, _val, summary.iters)
+
+    def tune(
+        self,
+        model: nn.Module,
+        loss_fn: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+        batch_sizes: Optional[Sequence[int]] = None,
+        data_workers: Optional[Sequence[int]] = None,
+        num_threads: Optional[Sequence[int]] = None,
+        memory_budget: Optional[int] = None,
+        probe_iters: int = 20,
+        apply: bool = True,
+    ) -> Dict[str, int]:
+        """Find the batch size, data workers, and threads with the best throughput.
+
+        Args:
+            model: Model (`nn.Module` instance) to probe with.
+            loss_fn: Loss function mapping input tensors to a loss tensor.
+            batch_sizes: Batch sizes to try. Default is `batch_size` times powers of 2,
+                from 1/4 to 8.
+            data_workers: Numbers of data loader workers to try. Default is 0, 1, 2,
+                4, and `data_workers` (up to the number of CPUs). Ignored if
+                `device_data` is `True`.
+            num_threads: Numbers of intra-op threads to try. Default is 1, and half
+                and all of `torch.get_num_threads()`.
+            memory_budget: Maximum peak allocated CUDA memory, in bytes, for a
+                setting to be accepted (default: no limit). Peak memory is measured
+                separately for each probe. Ignored (with a warning) when not training
+                on CUDA, since the peak memory of the process and data loader workers
+                can't be measured per probe on CPU.
+            probe_iters: Number of timed training iterations for each probe (after
+                2 warm up iterations).
+            apply: Whether to apply the chosen settings to this trainer, and to
+                `torch.set_num_threads`.
+
+        Returns:
+            Dictionary with the chosen `batch_size`, `data_workers`, and
+            `num_threads`.
+
+        The settings are tuned one at a time, in the order above, each with the best
+        values found for the previous ones. Each probe runs `probe_iters` training
+        iterations on the dataset (in a single process, with one batch per optimizer
+        step), and measures the throughput in samples per second. Batch sizes are
+        tried in increasing order, and stop at the first one which exceeds
+        `memory_budget` (or runs out of CUDA memory). Probes use a separate optimizer,
+        and the model weights, gradients, and training mode, and random number
+        generator states, are restored afterwards, so that tuning does not affect
+        training. Each setting is probed once, and probe results are logged.
+        """
+        if self._dataset is None:
+            raise RuntimeError("dataset not set: call `set_dataset` before `tune`")
+        if self.precision == "fp16" and _default_device().type != "cuda":
+            raise ValueError("`fp16` precision needs CUDA: use `bf16` instead")
+        if memory_budget is not None and _default_device().type != "cuda":
+            logging.warning("`memory_budget` is only supported on CUDA: ignoring it")
+            memory_budget = None
+
+        if batch_sizes is None:
+            batch_sizes = [max(1, (self.batch_size << 3) >> _k) for _k in range(6)]
+        if data_workers is None:
+            data_workers = [0, 1, 2, 4, self.data_workers]
+        data_workers = [_n for _n in data_workers if _n <= max(1, os.cpu_count() or 1)]
+        if self.device_data:
+            data_workers = [self.data_workers]
+        if num_threads is None:
+            _n = torch.get_num_threads()
+            num_threads = [1, max(1, _n // 2), _n]
+        search_space = {
+            "batch_size": sorted(set(batch_sizes)),
+            "data_workers": sorted(set(data_workers)),
+            "num_threads": sorted(set(num_threads)),
+        }
+
+        orig_settings = {
+            "batch_size": self.batch_size,
+            "data_workers": self.data_workers,
+            "num_threads": torch.get_num_threads(),
+        }
+        orig_data_loader = self._data_loader
+        was_training = model.training
+        model = model.to(_default_device())
+        model_state = {_k: _v.clone() for _k, _v in model.state_dict().items()}
+        grads = [
+            None if _p.grad is None else _p.grad.clone() for _p in model.parameters()
+        ]
+        rng_state = self._get_rng_state()
+
+        best_settings = dict(orig_settings)
+        probe_rates: Dict[Tuple[int, ...], Optional[float]] = {}
+        try:
+            for _name, _values in search_space.items():
+                best_val, best_rate = None, 0.0
+                for _val in _values:
+                    settings = {**best_settings, _name: _val}
+                    settings_key = tuple(settings.values())
+                    if settings_key not in probe_rates:
+                        probe_rates[settings_key] = self._probe(
+                            model, loss_fn, settings, memory_budget, probe_iters
+                        )
+                    rate = probe_rates[settings_key]
+                    if rate is None:
+                        if _name == "batch_size":
+                            break
+                        continue
+                    if best_val is None or rate > best_rate:
+                        best_val, best_rate = _val, rate
+                if best_val is None:
+                    raise RuntimeError(
+                        f"no value of `{_name}` fits in memory budget: tried {_values}"
+                    )
+                best_settings[_name] = best_val
+        finally:
+            model.load_state_dict(model_state)
+            for _p, _grad in zip(model.parameters(), grads):
+                _p.grad = _grad
+            model.train(was_training)
+            self._set_rng_state(rng_state)
+            self.batch_size = orig_settings["batch_size"]
+            self.data_workers = orig_settings["data_workers"]
+            torch.set_num_threads(orig_settings["num_threads"])
+            self._data_loader = orig_data_loader
+
+        logging.info("%s: tuning: chose %s", self.pbar_desc, best_settings)
+        if apply:
+            self.batch_size = best_settings["batch_size"]
+            self.data_workers = best_settings["data_workers"]
+            torch.set_num_threads(best_settings["num_threads"])
+            self._data_loader = self._make_data_loader()
+        return best_settings
+
+    def _probe(
+        self,
+        model: nn.Module,
+        loss_fn: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+        settings: Dict[str, int],
+        memory_budget: Optional[int],
+        probe_iters: int,
+        n_warmup: int = 2,
+    ) -> Optional[float]:
+        # Run a short training probe with `settings`, and return the throughput in
+        # samples per second, or `None` if the probe exceeds `memory_budget` (which
+        # is only set on CUDA). The result is logged.
+        self.batch_size = settings["batch_size"]
+        self.data_workers = settings["data_workers"]
+        torch.set_num_threads(settings["num_threads"])
+        autocast_dtype = torch.float16 if self.precision == "fp16" else torch.bfloat16
+        grad_scaler = GradScaler() if self.precision == "fp16" else None
+        ptopt = PTOpt(
+            optim_cls=self.ptopt.optim_cls,
+            optim_params=self.ptopt.optim_params,
+            optim_impl=self.ptopt.optim_impl,
+            optim_state=self.ptopt.optim_state,
+        )
+        ptopt.set_weights(model.parameters())
+        model.train()
+        if _default_device().type == "cuda":
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(_default_device())
+
+        bat_iter = self._iter_batches(
+            self._make_data_loader(), n_warmup + probe_iters, data_seed=0
+        )
+        n_samples, t_start = 0, 0.0
+        try:
+            for _i, _bat in enumerate(bat_iter):
+                if _i == n_warmup:
+                    if _default_device().type == "cuda":
+                        torch.cuda.synchronize()
+                    t_start = time.perf_counter()
+                ptopt.zero_grad()
+                x_bat, _, _, _ = self._accumulate_grads(
+                    model,
+                    loss_fn,
+                    self._split_micro_batches([_bat]),
+                    autocast_dtype,
+                    grad_scaler,
+                    _PhaseTimer(False),
+                )
+                ptopt.step(grad_scaler)
+                if _i >= n_warmup:
+                    n_samples += len(x_bat)
+            if _default_device().type == "cuda":
+                torch.cuda.synchronize()
+        except RuntimeError as e:
+            if "out of memory" not in str(e):
+                raise
+            if _default_device().type == "cuda":
+                torch.cuda.empty_cache()
+            logging.info("%s: tuning: %s: out of memory", self.pbar_desc, settings)
+            return None
+        t_elapsed = time.perf_counter() - t_start
+
+        # Peak memory stats are reset at the start of each probe.
+        peak_memory = _peak_memory()
+        if (
+            memory_budget is not None
+            and peak_memory is not None
+            and peak_memory > memory_budget
+        ):
+            logging.info(
+                "%s: tuning: %s: over memory budget (%d bytes)",
+                self.pbar_desc,
+                settings,
+                peak_memory,
+            )
+            return None
+        rate = n_samples / t_elapsed
+        logging.info("%s: tuning: %s: %.1f samples/sec", self.pbar_desc, settings, rate)
+        return rate
+
+
+def _no_op(*args, **kwargs):
+    pass
+
+
+class _NullWriter:
+    # Writer with the interface of `SummaryWriter`, which ignores every call, and
+    # keeps no state. Common methods are class attributes, so calling them costs
+    # the same as calling an empty function.
+
+    __slots__ = ()
+    log_dir = None
+    add_scalar = add_scalars = add_histogram = flush = close = staticmethod(_no_op)
+
+    def __getattr__(self, name: str) -> Callable[..., None]:
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return _no_op
+
+
+class _FileWriter:
+    # Minimal replacement for `SummaryWriter`, used when tensorboard is not
+    # installed. Scalars and histograms are appended, as JSON lines, to
+    # `<log_dir>/events.jsonl`. Other `SummaryWriter` methods are no-ops, with a
+    # warning on first use.
+
+    FILE_NAME = "events.jsonl"
+
+    def __init__(self, log_dir: str):
+        self.log_dir = log_dir
+        os.makedirs(log_dir, exist_ok=True)
+        self._file = open(  # pylint: disable=consider-using-with
+            os.path.join(log_dir, self.FILE_NAME), "a", encoding="utf-8"
+        )
+        self._warned: Set[str] = set()
+
+    def _write(self, record: Dict[str, Any]):
+        if record["walltime"] is None:
+            record["walltime"] = time.time()
+        self._file.write(json.dumps(record) + "\n")
+
+    def add_scalar(
+        self,
+        tag: str,
+        scalar_value: Any,
+        global_step: Optional[int] = None,
+        walltime: Optional[float] = None,
+        **kwargs,
+    ):
+        if isinstance(scalar_value, torch.Tensor):
+            scalar_value = scalar_value.item()
+        self._write(
+            {
+                "tag": tag,
+                "value": float(scalar_value),
+                "step": global_step,
+                "walltime": walltime,
+            }
+        )
+
+    def add_scalars(
+        self,
+        main_tag: str,
+        tag_scalar_dict: Dict[str, Any],
+        global_step: Optional[int] = None,
+        walltime: Optional[float] = None,
+    ):
+        walltime = time.time() if walltime is None else walltime
+        for _tag, _value in tag_scalar_dict.items():
+            self.add_scalar(f"{main_tag}/{_tag}", _value, global_step, walltime)
+
+    def add_histogram(
+        self,
+        tag: str,
+        values: Any,
+        global_step: Optional[int] = None,
+        bins: Any = 64,
+        walltime: Optional[float] = None,
+        **kwargs,
+    ):
+        values = torch.as_tensor(values).detach().flatten().double().cpu()
+        if not isinstance(bins, int):
+            bins = 64
+        if values.numel():
+            counts, edges = torch.histogram(values, bins)
+        else:
+            counts, edges = torch.zeros(0), torch.zeros(0)
+        self._write(
+            {
+                "tag": tag,
+                "histogram": {
+                    "num": values.numel(),
+                    "sum": values.sum().item(),
+                    "sum_squares": values.square().sum().item(),
+                    "min": values.min().item() if values.numel() else None,
+                    "max": values.max().item() if values.numel() else None,
+                    "bucket_limits": edges[1:].tolist(),
+                    "bucket_counts": counts.tolist(),
+                },
+                "step": global_step,
+                "walltime": walltime,
+            }
+        )
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __getattr__(self, name: str) -> Callable[..., None]:
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def _no_op(*args, **kwargs):
+            if name not in self._warned:
+                self._warned.add(name)
+                warnings.warn(
+                    f"`{name}` is ignored: tensorboard not installed", RuntimeWarning
+                )
+
+        return _no_op
+
+
+class _BufferedWriter:
+    # Wrapper around a `SummaryWriter` which queues method calls in memory, and makes
+    # them from a background thread, so that logging doesn't add Python work to the
+    # training loop. Pending calls are written every `flush_secs` seconds, when
+    # there are `max_pending` of them, and on `flush`/`close`. Tensor arguments are
+    # cloned (without synchronizing with CUDA) so that later in-place changes don't
+    # affect logged values, and `walltime` is recorded when calls are queued.
+
+    def __init__(self, writer: Any, flush_secs: float, max_pending: int):
+        self.writer = writer
+        self.flush_secs = flush_secs
+        self.max_pending = max_pending
+        self._pending: List[Tuple[str, tuple, Dict[str, Any]]] = []
+        self._pending_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_secs)
+            self._wake.clear()
+            self._write_pending()
+
+    def _write_pending(self):
+        with self._write_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, []
+            if self._error is not None:
+                return
+            try:
+                for _name, _args, _kwargs in pending:
+                    getattr(self.writer, _name)(*_args, **_kwargs)
+                self.writer.flush()
+            except Exception as e:  # pylint: disable=broad-except
+                logging.error("buffered tensorboard writer failed: %s", e)
+                self._error = e
+
+    def _put(self, name: str, args: tuple, kwargs: Dict[str, Any]):
+        if self._error is not None:
+            raise RuntimeError("buffered tensorboard writer failed") from self._error
+        if self._closed:
+            raise RuntimeError("buffered tensorboard writer is closed")
+        args = tuple(
+            _a.detach().clone() if isinstance(_a, torch.Tensor) else _a for _a in args
+        )
+        kwargs = {
+            _k: _v.detach().clone() if isinstance(_v, torch.Tensor) else _v
+            for _k, _v in kwargs.items()
+        }
+        with self._pending_lock:
+            self._pending.append((name, args, kwargs))
+            n_pending = len(self._pending)
+        if n_pending >= self.max_pending:
+            self._wake.set()
+
+    def add_scalar(
+        self,
+        tag: str,
+        scalar_value: Any,
+        global_step: Optional[int] = None,
+        walltime: Optional[float] = None,
+        **kwargs,
+    ):
+        walltime = time.time() if walltime is None else walltime
+        self._put("add_scalar", (tag, scalar_value, global_step, walltime), kwargs)
+
+    def add_histogram(
+        self,
+        tag: str,
+        values: Any,
+        global_step: Optional[int] = None,
+        bins: Any = "tensorflow",
+        walltime: Optional[float] = None,
+        max_bins: Optional[int] = None,
+    ):
+        walltime = time.time() if walltime is None else walltime
+        self._put(
+            "add_histogram",
+            (tag, values, global_step, bins, walltime),
+            {"max_bins": max_bins},
+        )
 
-                self.ptopt.zero_grad()
-                loss.backward()
-                self.ptopt.step()
+    def flush(self):
+        self._write_pending()
+        if self._error is not None:
+            raise RuntimeError("buffered tensorboard writer failed") from self._error
 
-                if post_iter_hook is not None:
-                    post_iter_hook(_iter, x_bat, y_bat, yhat_bat, loss, pbar)
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self._write_pending()
+        atexit.unregister(self.close)
+
+    def __getattr__(self, name: str) -> Callable[..., None]:
+        # Other `SummaryWriter` methods are also queued, to keep calls in order.
+        if name.startswith("_") or not callable(getattr(self.writer, name)):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._put(name, args, kwargs)
 
 
 class TBLogs:
@@ -393,26 +3124,81 @@ class TBLogs:
     Args:
         path: Path to log directory. If `None` (default), a mock instance is
             returned.
+        flush_secs: Interval (in seconds) at which `buffered` writes pending data.
+        max_pending: Number of pending calls at which `buffered` writes them,
+            without waiting for `flush_secs`.
 
     Usage::
 
         tb_logs = TBLogs("tmp/tb")
         tb_logs.writer  # `SummaryWriter` instance
+        tb_logs.buffered.add_scalar("loss", loss, i)  # asynchronous logging
+        tb_logs.close()
         TBLogs.mock  # mock instance
+
+    If tensorboard is not installed, `writer` is a minimal replacement, which
+    appends scalars and histograms to `events.jsonl` in the log directory (as JSON
+    lines with `tag`, `step`, `walltime`, and `value` or `histogram`), and ignores
+    other data.
     """
 
     __metavar__ = "dir"
     _mock: Optional["TBLogs"] = None
 
-    def __init__(self, path: Optional[str] = None):
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        flush_secs: float = 10,
+        max_pending: int = 1000,
+    ):
+        self.flush_secs = flush_secs
+        self.max_pending = max_pending
+        self._buffered: Optional[_BufferedWriter] = None
         if path is not None:
             try:
                 from torch.utils.tensorboard import SummaryWriter
             except ImportError:
-                raise RuntimeError("tensorboard not installed") from None
-            self.writer = SummaryWriter(path)
+                warnings.warn(
+                    "tensorboard not installed: writing scalars and histograms to "
+                    f"`{os.path.join(path, _FileWriter.FILE_NAME)}`",
+                    RuntimeWarning,
+                )
+                self.writer: Any = _FileWriter(path)
+            else:
+                self.writer = SummaryWriter(path)
         else:
-            self.writer = Mock()
+            self.writer = _NullWriter()
+
+    @property
+    def buffered(self) -> Any:
+        """Writer with the interface of `writer`, which logs asynchronously.
+
+        Calls are queued, and made on `writer` from a background thread. Pending
+        calls are written every `flush_secs` seconds, when `max_pending` calls are
+        queued, and on `flush`/`close` (and at interpreter exit). Tensor arguments
+        are copied when calls are queued, without synchronizing with the GPU. For
+        the mock instance, this is the same as `writer`.
+        """
+        if isinstance(self.writer, _NullWriter):
+            return self.writer
+        if self._buffered is None:
+            self._buffered = _BufferedWriter(
+                self.writer, self.flush_secs, self.max_pending
+            )
+        return self._buffered
+
+    def flush(self):
+        """Write pending data to disk."""
+        if self._buffered is not None:
+            self._buffered.flush()
+        else:
+            self.writer.flush()
+
+    def close(self):
+        """Write pending data, and close the writers."""
+        if self._buffered is not None:
+            self._buffered.close()
+        self.writer.close()
 
     @classmethod
     @property
@@ -423,6 +3209,6 @@ class TBLogs:
         return cls._mock
 
     def __repr__(self) -> str:
-        if isinstance(self.writer, Mock):
+        if isinstance(self.writer, _NullWriter):
             return "TBLogs.mock"
         return f"TBLogs({self.writer.log_dir!r})"